@@ -1,55 +1,235 @@
 from utils import *
 import torch.nn.functional as F
 import numpy as np
+import math
 
-def attack_pgd(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, tar=None, prompt=None, deep=False):
-    max_loss = torch.zeros(y.shape[0]).cuda()
-    max_delta = torch.zeros_like(X).cuda()
-    for zz in range(restarts):
-        delta = torch.zeros_like(X).cuda()
-        for i in range(len(epsilon)):
-            delta[:, i, :, :].uniform_(-epsilon[i][0][0].item(), epsilon[i][0][0].item())
-        delta.data = clamp(delta, lower_limit - X, upper_limit - X)
-        delta.requires_grad = True
-        for _ in range(attack_iters):
-            output = model(X + delta, prompt, deep=deep)
-            if tar is None:
-                loss = F.cross_entropy(output, y)
-            elif tar is not None:
-                loss = -F.cross_entropy(output, tar)
-            loss.backward()
-            grad = delta.grad.detach()
-            d = delta[:, :, :, :]
-            g = grad[:, :, :, :]
-            d = clamp(d + alpha * torch.sign(g), -epsilon, epsilon)
-            d = clamp(d, lower_limit - X[:, :, :, :], upper_limit - X[:, :, :, :])
-            delta.data[:, :, :, :] = d
-            delta.grad.zero_()
-        delta = delta.detach()
-        # output = output.detach()
-        all_loss = F.cross_entropy(model(X+delta, prompt, deep=deep), y, reduction='none').detach()
-        max_delta[all_loss >= max_loss] = delta.detach()[all_loss >= max_loss]
+def embed_clean(model, X):
+    # clean tokens (cls + pos_embed added), reused across every perturbed forward of X
+    return unwrap_model(model).embed(X)
+
+def perturbed(model, X, delta, prompt=None, deep=False, clean=None):
+    if clean is None:
+        return model(X if delta is None else X + delta, prompt, deep=deep)
+    return model(delta, prompt, deep=deep, clean=clean)
+
+def init_delta(X, epsilon, lower_limit, upper_limit):
+    # uniform in the epsilon ball, epsilon a float or per-channel (3, 1, 1)
+    delta = torch.empty_like(X).uniform_(-1, 1).mul_(epsilon)
+    return clamp(delta, lower_limit - X, upper_limit - X)
+
+class PGDState():
+    """ Perturbation of one batch for sign-gradient L_inf attacks, updated in place.
+    The epsilon ball and the image box are folded into one pair of per-sample bounds when the state is built,
+    clamp(clamp(d, -eps, eps), lower - X, upper - X) == clamp(d, lo, hi), so a step is one sign/scale of the
+    autograd gradient and one clamp_. project=False keeps only the box (N-FGSM), epsilon then only sets the
+    range of the random start.
+    """
+    def __init__(self, X, epsilon, alpha, lower_limit, upper_limit, project=True):
+        box_lo, box_hi = lower_limit - X, upper_limit - X
+        if project:
+            self.lo = torch.minimum(box_lo.clamp(min=-epsilon), box_hi)
+            self.hi = torch.minimum(box_lo.clamp(min=epsilon), box_hi)
+        else:
+            self.lo, self.hi = box_lo, box_hi
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.delta = torch.zeros_like(X, requires_grad=True)
+
+    @torch.no_grad()
+    def reset(self, delta=None):
+        """ uniform start in the epsilon ball, or delta, projected """
+        if delta is None:
+            self.delta.uniform_(-1, 1).mul_(self.epsilon)
+        else:
+            self.delta.copy_(delta)
+        return self.project()
+
+    @torch.no_grad()
+    def project(self):
+        return self.delta.clamp_(self.lo, self.hi)
+
+    @torch.no_grad()
+    def step(self, grad):
+        """ delta <- proj(delta + alpha * sign(grad)), grad is overwritten """
+        self.delta.add_(grad.sign_().mul_(self.alpha))
+        self.delta.clamp_(self.lo, self.hi)
+        return self.delta
+
+def pgd_restarts(model, X, y, epsilon, alpha, attack_iters, n, lower_limit, upper_limit, tar=None, prompt=None, deep=False, clean=None,
+                 delta_init=None):
+    """ n PGD restarts stacked along the batch dimension, returns deltas and final losses as (n, B, ...) 
+    delta_init (B, ...) replaces the random start of the first restart.
+    """
+    B = X.size(0)
+    if n > 1:
+        X = X.repeat(n, 1, 1, 1)
+        y = y.repeat(n)
+        tar = tar.repeat(n) if tar is not None else None
+        clean = clean.repeat(n, 1, 1) if clean is not None else None
+    state = PGDState(X, epsilon, alpha, lower_limit, upper_limit)
+    delta = state.reset()
+    if delta_init is not None:
+        with torch.no_grad():
+            delta[:B] = delta_init
+        state.project()
+    for _ in range(attack_iters):
+        output = perturbed(model, X, delta, prompt, deep=deep, clean=clean)
+        if tar is None:
+            loss = F.cross_entropy(output, y)
+        elif tar is not None:
+            loss = -F.cross_entropy(output, tar)
+        # samples are independent, so the mean over n*B only rescales each sample's gradient
+        grad = torch.autograd.grad(loss, delta)[0]
+        state.step(grad)
+    delta = delta.detach()
+    all_loss = F.cross_entropy(perturbed(model, X, delta, prompt, deep=deep, clean=clean), y, reduction='none').detach()
+    return delta.view(n, B, *delta.shape[1:]), all_loss.view(n, B)
+
+def attack_pgd(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, tar=None, prompt=None, deep=False, clean=None,
+               restart_batch=1, delta_init=None):
+    """ restart_batch restarts run stacked in one loop (0 for all of them), halved whenever R x B runs out of memory.
+    delta_init warm-starts the first restart instead of uniform noise.
+    """
+    if clean is not None:
+        clean = clean.detach()
+    max_loss = torch.zeros(y.shape[0], device=X.device)
+    max_delta = torch.zeros_like(X)
+    n = restarts if restart_batch <= 0 else min(restart_batch, restarts)
+    done = 0
+    while done < restarts:
+        k = min(n, restarts - done)
+        try:
+            delta, all_loss = pgd_restarts(model, X, y, epsilon, alpha, attack_iters, k, lower_limit, upper_limit,
+                                           tar=tar, prompt=prompt, deep=deep, clean=clean,
+                                           delta_init=delta_init if done == 0 else None)
+        except torch.cuda.OutOfMemoryError:
+            if k == 1:
+                raise
+            n = k // 2
+            if X.is_cuda:
+                torch.cuda.empty_cache()
+            continue
+        # last restart reaching the max loss wins, same as the sequential >= update
+        best = k - 1 - all_loss.flip(0).argmax(0)
+        all_loss = all_loss.gather(0, best[None])[0]
+        delta = delta[best, torch.arange(y.size(0), device=best.device)]
+        max_delta[all_loss >= max_loss] = delta[all_loss >= max_loss]
         max_loss = torch.max(max_loss, all_loss)
+        done += k
     return max_delta
 
-def attack_cw(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, opt=None, prompt=None, a_lam=-1, deep=False, num_cls=10):
-    max_loss = torch.zeros(y.shape[0]).cuda()
-    max_delta = torch.zeros_like(X).cuda()
+def rng_state(device):
+    return torch.cuda.get_rng_state(device) if device.type == 'cuda' else torch.get_rng_state()
+
+class RestartGroup():
+    """ Rows of one pool batch running the same restart, with their PGDState and steps taken so far """
+    def __init__(self, batch, rows, restart, epsilon, alpha, lower_limit, upper_limit):
+        self.batch, self.rows, self.restart, self.it = batch, rows, restart, 0
+        self.X, self.y = batch['X'][rows], batch['y'][rows]
+        self.clean = batch['clean'][rows] if batch['clean'] is not None else None
+        # the start attack_pgd draws for this restart: the whole batch's noise from its saved generator state
+        gen = torch.Generator(device=self.X.device)
+        gen.set_state(batch['rng'][restart])
+        noise = torch.empty_like(batch['X']).uniform_(-1, 1, generator=gen).mul_(epsilon)
+        self.state = PGDState(self.X, epsilon, alpha, lower_limit, upper_limit)
+        self.state.reset(noise[rows])
+
+def pgd_restart_pool(model, batches, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, capacity,
+                     prompt=None, deep=False, retire=True):
+    """ attack_pgd (restart_batch 1) over an iterable of (X, y, clean) device batches, clean None without reused
+    embeddings, skipping the remaining restarts of samples fooled for good.
+    A sample retires after a restart ending with a CE above log(classes): a later restart only replaces the delta
+    with one of at least that loss, which is misclassified too (a correct prediction has p_y >= 1/classes), so the
+    prediction on the returned delta is the one of the full attack. Only the loss of a retired sample can be lower.
+    retire=False (the prediction is taken with another prompt) runs every restart.
+    The samples of several batches, each at its own restart and step, share one active set of capacity rows that
+    is refilled from the next batches as samples retire, so every step runs a full batch. A batch draws its
+    restarts' random starts from the global generator when it enters, as attack_pgd would, and later replays them.
+    Yields (X, y, clean, max-loss delta, sample restarts run) for every batch once all its samples are done.
+    """
+    batches = iter(batches)
+    groups, feed, size = [], None, 0
+    while True:
+        # refill the active set, splitting the next batch when only part of it fits
+        while size < capacity:
+            if feed is None or feed['next'] == feed['y'].size(0):
+                X, y, clean = next(batches, (None, None, None))
+                if X is None:
+                    break
+                states = []
+                for _ in range(restarts):
+                    states.append(rng_state(X.device))
+                    torch.empty_like(X).uniform_(-1, 1)
+                feed = {'X': X, 'y': y, 'clean': clean.detach() if clean is not None else None, 'rng': states, 'next': 0,
+                        'active': 0, 'attacked': 0, 'max_loss': torch.zeros(y.shape[0], device=X.device),
+                        'max_delta': torch.zeros_like(X)}
+            k = min(capacity - size, feed['y'].size(0) - feed['next'])
+            rows = torch.arange(feed['next'], feed['next'] + k, device=feed['y'].device)
+            groups.append(RestartGroup(feed, rows, 0, epsilon, alpha, lower_limit, upper_limit))
+            feed['next'] += k
+            feed['active'] += k
+            size += k
+        if not groups:
+            return
+        finished = [g for g in groups if g.it == attack_iters]
+        if finished:
+            with torch.no_grad():
+                delta = torch.cat([g.state.delta for g in finished])
+                clean = torch.cat([g.clean for g in finished]) if finished[0].clean is not None else None
+                output = perturbed(model, torch.cat([g.X for g in finished]), delta, prompt, deep=deep, clean=clean)
+                losses = F.cross_entropy(output, torch.cat([g.y for g in finished]), reduction='none').split(
+                    [len(g.rows) for g in finished])
+            for g, loss in zip(finished, losses):
+                b = g.batch
+                better = loss >= b['max_loss'][g.rows]
+                b['max_delta'][g.rows[better]] = g.state.delta.detach()[better]
+                b['max_loss'][g.rows] = torch.max(b['max_loss'][g.rows], loss)
+                b['attacked'] += len(g.rows)
+                groups.remove(g)
+                size -= len(g.rows)
+                b['active'] -= len(g.rows)
+                rows = g.rows[loss <= math.log(output.size(1))] if retire else g.rows
+                if g.restart + 1 < restarts and len(rows):
+                    groups.append(RestartGroup(b, rows, g.restart + 1, epsilon, alpha, lower_limit, upper_limit))
+                    size += len(rows)
+                    b['active'] += len(rows)
+            for b in {id(g.batch): g.batch for g in finished}.values():
+                if b['active'] == 0 and b['next'] == b['y'].size(0):
+                    yield b['X'], b['y'], b['clean'], b['max_delta'], b['attacked']
+            continue
+        deltas = [g.state.delta for g in groups]
+        clean = torch.cat([g.clean for g in groups]) if groups[0].clean is not None else None
+        output = perturbed(model, torch.cat([g.X for g in groups]), torch.cat(deltas), prompt, deep=deep, clean=clean)
+        # summed, so a sample's gradient does not depend on how many others share the step
+        grads = torch.autograd.grad(F.cross_entropy(output, torch.cat([g.y for g in groups]), reduction='sum'), deltas)
+        for g, grad in zip(groups, grads):
+            g.state.step(grad)
+            g.it += 1
+
+def attack_pgd_skip_restarts(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, prompt=None,
+                             deep=False, clean=None, retire=True):
+    """ pgd_restart_pool on one batch: returns the max-loss delta and the number of sample restarts run """
+    [(_, _, _, delta, attacked)] = pgd_restart_pool(model, [(X, y, clean)], epsilon, alpha, attack_iters, restarts,
+                                                    lower_limit, upper_limit, X.size(0), prompt=prompt, deep=deep,
+                                                    retire=retire)
+    return delta, attacked
+
+def attack_cw(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, opt=None, prompt=None, a_lam=-1, deep=False, num_cls=10, clean=None):
+    if clean is not None:
+        clean = clean.detach()
+    max_loss = torch.zeros(y.shape[0], device=X.device)
+    max_delta = torch.zeros_like(X)
+    state = PGDState(X, epsilon, alpha, lower_limit, upper_limit)
     for zz in range(restarts):
-        delta = torch.zeros_like(X).cuda()
-        for i in range(len(epsilon)):
-            delta[:, i, :, :].uniform_(-epsilon[i][0][0].item(), epsilon[i][0][0].item())
-        delta.data = clamp(delta, lower_limit - X, upper_limit - X)
-        delta.requires_grad = True
+        delta = state.reset()
         for _ in range(attack_iters):
-            output = model(X + delta, prompt, deep=deep)
+            output = perturbed(model, X, delta, prompt, deep=deep, clean=clean)
 
             loss = CW_loss(output, y, num_cls=num_cls)
 
-            grad = torch.autograd.grad(loss, delta)[0].detach()
+            grad = torch.autograd.grad(loss, delta)[0]
 
-            delta.data = clamp(delta + alpha * torch.sign(grad), -epsilon, epsilon)
-            delta = clamp(delta, lower_limit - X, upper_limit - X)
+            state.step(grad)
         delta = delta.detach()
     return delta
 
@@ -62,7 +242,7 @@ def CW_loss(x, y, reduction=True, num_cls=10, threshold=10):
     logit_mc = x_sorted[:, -2] * ind + x_sorted[:, -1] * (1. - ind)
     logit_gt = x[np.arange(batch_size), y]
     loss_value_ori = -(logit_gt - logit_mc)
-    loss_value = torch.maximum(loss_value_ori, torch.tensor(-threshold).cuda())
+    loss_value = torch.maximum(loss_value_ori, x.new_tensor(-threshold))
 
     if reduction:
         return loss_value.mean()
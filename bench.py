@@ -0,0 +1,550 @@
+#### Micro-benchmarks for the attack/training hot paths
+## usage: python bench.py --bench frozen --model vit_base_patch16_224 --params P2T --scratch ...
+import argparse
+import copy
+import os
+import shutil
+import tempfile
+import time
+import torch
+import numpy as np
+import torch.nn.functional as F
+from parser import get_args
+from model import get_model_prompt, save_checkpoint
+from utils import all_reduce_grads, clamp, get_geometry, get_loaders, setup_device, unwrap_model
+from attacks import PGDState, attack_pgd
+from evaluate import evaluate_natural, evaluate_pgd
+import losses
+
+
+def get_loss_fn(args):
+    if args.method == 'ADAPT':
+        return getattr(losses, 'ADAPT_' + args.adapt_loss.upper())
+    return getattr(losses, args.method)
+
+
+def random_batch(args, n=None):
+    n = n or args.batch_size
+    X = torch.randn(n, 3, args.crop, args.crop, device=args.device)
+    y = torch.randint(0, 10, (n,), device=args.device)
+    return X, y
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed(fn, iters=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    synchronize()
+    return (time.time() - start) / iters
+
+
+def peak_memory(fn):
+    # CUDA allocator peak in MB, nan on CPU where there is no per-call peak to read
+    if not torch.cuda.is_available():
+        fn()
+        return float('nan')
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
+def check_close(what, ref, out, tol=1e-4):
+    """ Asserts out matches ref within tol of the largest |ref| entry; a NaN anywhere fails """
+    err = ((out - ref).abs().max() / ref.abs().max()).item()
+    print('{}: max rel diff {:.2e}'.format(what, err))
+    assert err <= tol, '{} differ by {:.2e} > {:.0e}'.format(what, err, tol)
+
+
+def count_allocations(fn):
+    """ (number, MB) of the tensor allocations made by fn """
+    if torch.cuda.is_available():
+        before = torch.cuda.memory_stats()
+        fn()
+        after = torch.cuda.memory_stats()
+        return (after['allocation.all.allocated'] - before['allocation.all.allocated'],
+                (after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated']) / 2**20)
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    allocs = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+    return len(allocs), sum(allocs) / 2**20
+
+
+def bench_frozen(args):
+    """ Train step time and peak memory with and without --freeze-backbone """
+    loss_fn = get_loss_fn(args)
+    X, y = random_batch(args)
+    for frozen in [False, True]:
+        args.freeze_backbone = frozen
+        model, prompt, params, _, _ = get_model_prompt(args)
+        opt = torch.optim.SGD(params, lr=args.lr_max, momentum=args.momentum, weight_decay=args.weight_decay)
+        if frozen:
+            clip_params = [p for group in opt.param_groups for p in group['params']]
+        else:
+            clip_params = list(model.parameters())
+        model.train()
+
+        def step():
+            loss = loss_fn(model, prompt, X, y, args).loss
+            opt.zero_grad()
+            model.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(clip_params, args.grad_clip)
+            opt.step()
+
+        t = timed(step)
+        mem = peak_memory(step)
+        print('freeze_backbone={} step {:.4f}s peak mem {:.0f}MB'.format(frozen, t, mem))
+        del model, opt
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def bench_methods(args):
+    """ Training throughput of --methods (e.g. ADAPT ADAPT_NFGSM). Catastrophic overfitting shows up in the
+    per-epoch 'test adv acc' (PGD10) that train_adv already logs.
+    """
+    X, y = random_batch(args)
+    model, prompt, params, _, _ = get_model_prompt(args)
+    opt = torch.optim.SGD(params, lr=args.lr_max, momentum=args.momentum, weight_decay=args.weight_decay)
+    model.train()
+    for method in args.methods:
+        args.method = method
+        loss_fn = get_loss_fn(args)
+        store = losses.FreeDelta() if method == 'ADAPT_FREE' else None
+
+        def step():
+            loss = loss_fn(model, prompt, X, y, args, store=store).loss
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+
+        t = timed(step)
+        print('{} ({}, attack_iters={}): {:.4f}s/step {:.1f} img/s'.format(
+            method, args.adapt_loss, args.attack_iters, t, X.size(0) / t))
+
+
+def bench_prefix_kv(args):
+    """ Checks --prefix-kv against the default P2T path (logits and input gradient), with time per fwd+input grad """
+    X, y = random_batch(args)
+    saved = args.params, args.prefix_kv, args.deep_p
+    args.params, args.deep_p = 'P2T', False
+    results = []
+    for prefix_kv in [False, True]:
+        args.prefix_kv = prefix_kv
+        torch.manual_seed(args.seed)  # same weights and prompt for both paths
+        model, prompt, _, _, _ = get_model_prompt(args)
+        model.eval()
+
+        def step():
+            delta = torch.zeros_like(X, requires_grad=True)
+            out = model(X + delta, prompt)
+            grad = torch.autograd.grad(F.cross_entropy(out, y), delta)[0]
+            return out.detach(), grad
+
+        results.append(step())
+        print('prefix_kv={} fwd+input grad {:.4f}s'.format(prefix_kv, timed(step)))
+        del model
+    (out_d, grad_d), (out_p, grad_p) = results
+    check_close('prefix-kv vs default logits', out_d, out_p)
+    check_close('prefix-kv vs default input grad', grad_d, grad_p)
+    args.params, args.prefix_kv, args.deep_p = saved
+
+
+def bench_attn(args):
+    """ Checks --attn-impl sdpa against the math path (logits and input gradient, dropout off) in the default and
+    the --prefix-kv token layouts, with time and peak memory. The prefix layout needs P2T prompts, so it runs P2T.
+    """
+    X, y = random_batch(args)
+    saved = args.params, args.prefix_kv, args.deep_p
+    for layout in ['default', 'prefix']:
+        if layout == 'prefix':
+            args.params, args.prefix_kv, args.deep_p = 'P2T', True, False
+        results = []
+        for impl in ['math', 'sdpa']:
+            args.attn_impl = impl
+            torch.manual_seed(args.seed)  # same weights and prompt for both backends
+            model, prompt, _, _, _ = get_model_prompt(args)
+            model.eval()
+
+            def step():
+                delta = torch.zeros_like(X, requires_grad=True)
+                out = model(X + delta, prompt, deep=args.deep_p)
+                grad = torch.autograd.grad(F.cross_entropy(out, y), delta)[0]
+                return out.detach(), grad
+
+            results.append(step())
+            print('{} layout, attn_impl={} fwd+input grad {:.4f}s peak mem {:.0f}MB'.format(
+                layout, impl, timed(step), peak_memory(step)))
+            del model
+        (out_m, grad_m), (out_s, grad_s) = results
+        check_close('{} layout sdpa vs math logits'.format(layout), out_m, out_s)
+        check_close('{} layout sdpa vs math input grad'.format(layout), grad_m, grad_s)
+    args.params, args.prefix_kv, args.deep_p = saved
+
+
+def bench_skip_restarts(args):
+    """ evaluate_pgd over --num-eval samples with and without --eval-skip-restarts (e.g. --eval-iters 50 --eval-restarts 10),
+    asserting the same robust accuracy
+    """
+    model, prompt, _, _, _ = get_model_prompt(args)
+    model.eval()
+    _, test_loader = get_loaders(args)
+    steps = -(-args.num_eval // test_loader.batch_size)
+    args.restart_batch = 1  # the random starts --eval-skip-restarts replays
+    accs = []
+    for skip in [False, True]:
+        args.eval_skip_restarts = skip
+        torch.manual_seed(args.seed)  # same eval subset and random starts for both runs
+        start = time.time()
+        loss, acc = evaluate_pgd(args, model, test_loader, eval_steps=steps, prompt=prompt, unadapt=args.unadapt)
+        print('eval_skip_restarts={} PGD{} x{} restarts: acc {:.4f} loss {:.4f} time {:.1f}s'.format(
+            skip, args.eval_iters, args.eval_restarts, acc, loss, time.time() - start))
+        accs.append(acc)
+    assert accs[0] == accs[1], 'skipping restarts changed the robust accuracy'
+
+
+def bench_cpu_eval(args):
+    """ evaluate_natural / evaluate_pgd throughput for vit_small and vit_base on args.device over --num-eval
+    synthetic samples (e.g. --device cpu --threads 16 --num-eval 256 --dataset cifar100)
+    """
+    X = torch.rand(args.num_eval, 3, args.crop, args.crop)
+    y = torch.randint(0, 10, (args.num_eval,))
+    loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, y), batch_size=args.batch_size)
+    print('device {} intra-op threads {} inter-op threads {}'.format(
+        args.device, torch.get_num_threads(), torch.get_num_interop_threads()))
+    for name in ['vit_small_patch16_224', 'vit_base_patch16_224']:
+        args.model = name
+        model, prompt, _, _, _ = get_model_prompt(args)
+        model.eval()
+        for evaluator in ['natural', 'pgd']:
+            start = time.time()
+            if evaluator == 'natural':
+                evaluate_natural(args, model, loader, None, prompt=prompt)
+            else:
+                evaluate_pgd(args, model, loader, prompt=prompt, unadapt=args.unadapt)
+            t = time.time() - start
+            print('{} evaluate_{}: {:.1f}s {:.1f} img/s'.format(name, evaluator, t, args.num_eval / t))
+        del model
+
+
+def bench_fold_norm(args):
+    """ PGD (--attack-iters) in normalized space with per-channel bounds vs --fold-norm in [0,1] pixels with scalar
+    bounds, plus the max logit difference between the two models on the same images
+    """
+    pixels, y = random_batch(args)
+    pixels = pixels.uniform_(0, 1)
+    outs = []
+    for fold in [False, True]:
+        args.fold_norm, args.geometry = fold, None
+        g = get_geometry(args)
+        torch.manual_seed(args.seed)  # same weights and prompt, folded or not
+        model, prompt, _, _, _ = get_model_prompt(args)
+        model.eval()
+        X = g.to_model(pixels)
+
+        def attack():
+            return attack_pgd(model, X, y, g.epsilon, g.alpha, args.attack_iters, 1, g.lower_limit, g.upper_limit,
+                              prompt=prompt, deep=args.deep_p)
+
+        with torch.no_grad():
+            outs.append(model(X, prompt, deep=args.deep_p))
+        print('fold_norm={} PGD{} {:.4f}s/batch'.format(fold, args.attack_iters, timed(attack)))
+        del model
+    print('max |logit diff| {:.2e}'.format((outs[0] - outs[1]).abs().max().item()))
+
+
+def bench_pgd_step(args):
+    """ Allocations and latency of one PGD update (sign step + projection) before/after PGDState, then
+    attack_pgd per iteration including the forward/backward
+    """
+    g = get_geometry(args)
+    X, y = random_batch(args)
+    X = g.to_model(X.uniform_(0, 1))
+    epsilon, alpha, lower_limit, upper_limit = g.epsilon, g.alpha, g.lower_limit, g.upper_limit
+    grad = torch.randn_like(X)
+    delta = torch.zeros_like(X)
+
+    def legacy_step():
+        # the update attack_pgd made before PGDState
+        d = delta[:, :, :, :]
+        gr = grad[:, :, :, :]
+        d = clamp(d + alpha * torch.sign(gr), -epsilon, epsilon)
+        d = clamp(d, lower_limit - X[:, :, :, :], upper_limit - X[:, :, :, :])
+        delta.data[:, :, :, :] = d
+
+    state = PGDState(X, epsilon, alpha, lower_limit, upper_limit)
+    state.reset()
+    g_buf = grad.clone()
+
+    def state_step():
+        # autograd hands over a fresh gradient every iteration, the copy stands in for it
+        g_buf.copy_(grad)
+        state.step(g_buf)
+
+    for name, fn in [('before', legacy_step), ('PGDState', state_step)]:
+        n, mb = count_allocations(fn)
+        print('{:8s} update: {} allocations {:.1f}MB, {:.3f}ms'.format(name, n, mb, 1000 * timed(fn, iters=100, warmup=5)))
+
+    model, prompt, _, _, _ = get_model_prompt(args)
+    model.eval()
+    t = timed(lambda: attack_pgd(model, X, y, epsilon, alpha, args.attack_iters, 1, lower_limit, upper_limit,
+                                 prompt=prompt, deep=args.deep_p))
+    print('attack_pgd {:.4f}s/iteration'.format(t / args.attack_iters))
+
+
+def bench_data(args):
+    """ One pass over the train loader: PIL transforms with 16 workers vs --data-cache (default ./data_cache) batched
+    tensor augmentation, wall time and main-process CPU time
+    """
+    cache = args.data_cache or './data_cache'
+    for args.data_cache in ['', cache]:
+        train_loader, _ = get_loaders(args)
+        wall, cpu = time.time(), time.process_time()
+        n = sum(batch[1].size(0) for batch in train_loader)
+        wall, cpu = time.time() - wall, time.process_time() - cpu
+        print('data_cache={!r}: {} images {:.1f}s {:.0f} img/s, main process cpu {:.1f}s'.format(
+            args.data_cache, n, wall, n / wall, cpu))
+
+
+def bench_ckpt(args):
+    """ save_checkpoint/get_model_prompt --load time and file size for --ckpt-format full and compact,
+    checking that the reloaded prompt and logits match
+    """
+    X, _ = random_batch(args, 8)
+    torch.manual_seed(args.seed)
+    model, prompt, params, _, _ = get_model_prompt(args)
+    opt = torch.optim.SGD(params, lr=args.lr_max, momentum=args.momentum, weight_decay=args.weight_decay)
+    model.eval()
+    with torch.no_grad():
+        out = model(X, prompt, deep=args.deep_p)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for fmt in ['full', 'compact']:
+        args.ckpt_format = fmt
+        path = os.path.join(args.out_dir, 'bench_checkpoint_' + fmt)
+        save = timed(lambda: save_checkpoint(args, path, model, prompt, opt, 1), iters=3)
+        load_args = copy.copy(args)
+        load_args.load, load_args.load_path = True, path
+        torch.manual_seed(args.seed)  # the same (scratch) base weights as the saved model
+        start = time.time()
+        model2, prompt2, _, _, _ = get_model_prompt(load_args)
+        load = time.time() - start
+        model2.eval()
+        with torch.no_grad():
+            diff = (model2(X, prompt2, deep=args.deep_p) - out).abs().max().item()
+        print('{}: {:.1f}MB save {:.3f}s, get_model_prompt with load {:.3f}s, max |logit diff| {:.1e}'.format(
+            fmt, os.path.getsize(path) / 2**20, save, load, diff))
+        assert torch.equal(prompt2, prompt), '{} checkpoint: the reloaded prompt differs'.format(fmt)
+        assert diff <= 1e-5, '{} checkpoint: the reloaded model gives other logits'.format(fmt)
+        del model2
+
+
+def bench_startup(args):
+    """ get_model_prompt time (pretrained, so not with --scratch) without a weight store, with a cold one
+    (timm model, checkpoint_filter_fn, save) and a warm one (memory-mapped filtered weights)
+    """
+    store = tempfile.mkdtemp()
+    for name, args.weight_store in [('no store', ''), ('cold store', store), ('warm store', store)]:
+        start = time.time()
+        model, _, _, _, _ = get_model_prompt(args)
+        print('{}: {:.2f}s'.format(name, time.time() - start))
+        del model
+    shutil.rmtree(store)
+
+
+def bench_multitask(args):
+    """ forward_multi on a mixed batch of T tasks (prompt bank + head bank) against one forward per task,
+    asserting that the logits match
+    """
+    X, _ = random_batch(args)
+    model, prompt, _, _, _ = get_model_prompt(args)
+    model = unwrap_model(model).eval()
+    ncls = [10, 100, 10]  # cifar10, cifar100, imagenette
+    bank = torch.cat([torch.randn_like(prompt) * prompt.std() for _ in ncls]).detach()
+    heads = [torch.nn.Linear(model.embed_dim, n).to(args.device) for n in ncls]
+    index = torch.randint(0, len(ncls), (X.size(0),), device=args.device)
+
+    @torch.no_grad()
+    def per_task():
+        out = X.new_full((X.size(0), max(ncls)), -float('inf'))
+        for t, head in enumerate(heads):
+            rows = (index == t).nonzero()[:, 0]
+            feats, _ = model.forward_features(X[rows], bank[t:t+1], args.deep_p)
+            out[rows, :head.out_features] = head(feats)
+        return out
+
+    @torch.no_grad()
+    def multi():
+        return model.forward_multi(X, bank, index, heads, deep=args.deep_p)
+
+    for name, fn in [('per-task batches', per_task), ('forward_multi', multi)]:
+        print('{}: {:.1f} img/s'.format(name, X.size(0) / timed(fn)))
+    ref, out = per_task(), multi()
+    # -inf pads the classes past a sample's task in both, everything else has to be a finite match
+    pad = ref.isneginf()
+    assert torch.equal(out.isneginf(), pad), 'forward_multi pads other logits than the per-task batches'
+    check_close('forward_multi vs per-task logits', ref[~pad], out[~pad])
+
+
+def bench_serve(args, concurrency=32, requests=256):
+    """ serve.py under a closed-loop load generator: throughput, client p50/p99 latency and server batch sizes
+    without batching (max batch 1) and with micro-batching
+    """
+    import asyncio
+    import serve
+    model, prompt, _, _, _ = get_model_prompt(args)
+    model.eval()
+    images = serve.random_images(args, 16)
+
+    async def run(max_batch, max_latency):
+        server, batcher, task = await serve.start_server(args, model, prompt, '127.0.0.1', 0, max_batch, max_latency)
+        port = server.sockets[0].getsockname()[1]
+        await serve.load_test('127.0.0.1', port, images, concurrency, concurrency)  # warmup
+        batcher.latencies.clear()
+        batcher.batch_sizes.clear()
+        wall, latencies = await serve.load_test('127.0.0.1', port, images, concurrency, requests)
+        server.close()
+        task.cancel()
+        return wall, np.array(latencies) * 1000, batcher.metrics()
+
+    for max_batch, max_latency in [(1, 0.), (concurrency, 0.005)]:
+        wall, lat, metrics = asyncio.run(run(max_batch, max_latency))
+        print('max batch {} window {:.0f}ms: {:.1f} req/s, p50 {:.1f}ms p99 {:.1f}ms, batch sizes {}'.format(
+            max_batch, max_latency * 1000, requests / wall, np.percentile(lat, 50), np.percentile(lat, 99),
+            metrics['batch_size_hist']))
+
+
+def bench_sweep(args, K=4):
+    """ one sweep.py train_step of K members stacked through the backbone against K train.py steps one after another
+    (each member's prompt and head on the same backbone)
+    """
+    import sweep
+    args.freeze_backbone = True
+    members = sweep.get_members(args, [{'lr_max': args.lr_max * (k + 1)} for k in range(K)])
+    model, heads, prompts, params, opts, _ = sweep.build_group(members)
+    stack = sweep.Stack(model, heads)
+    loss_fn = get_loss_fn(members[0])
+    X, y = random_batch(args, K * args.batch_size)
+    stack.train()
+
+    def stacked():
+        sweep.train_step(stack, members, prompts, params, opts, X, y, loss_fn)
+
+    def sequential():
+        for k, member in enumerate(members):
+            rows = slice(k * args.batch_size, (k + 1) * args.batch_size)
+            unwrap_model(model).head = heads[k]
+            loss, _, _ = loss_fn(model, prompts[k], X[rows], y[rows], member)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(params[k], member.grad_clip)
+            opts[k].step()
+            opts[k].zero_grad()
+
+    for name, fn in [('sequential', sequential), ('stacked', stacked)]:
+        print('{} members {}: {:.3f}s per step, peak mem {:.0f}MB'.format(K, name, timed(fn, iters=3), peak_memory(fn)))
+
+
+def ddp_worker(rank, args, world_size, port, steps, results):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    args = copy.copy(args)
+    args.device = 'cpu'
+    args.threads = max(1, (os.cpu_count() or 1) // world_size)
+    setup_device(args)
+    torch.manual_seed(args.seed)
+    model, prompt, params, _, _ = get_model_prompt(args)
+    model.train()
+    opt = torch.optim.SGD(params, lr=args.lr_max, momentum=args.momentum, weight_decay=args.weight_decay)
+    trainable = [p for group in opt.param_groups for p in group['params']]
+    loss_fn = get_loss_fn(args)
+    X, y = random_batch(args)  # the global batch, the same on every process
+    b = args.batch_size // world_size
+    X, y = X[rank * b:(rank + 1) * b], y[rank * b:(rank + 1) * b]
+    grad = None
+
+    def step():
+        nonlocal grad
+        loss, _, _ = loss_fn(model, prompt, X, y, args)
+        loss.backward()
+        all_reduce_grads(args, trainable)
+        grad = prompt.grad.clone() if grad is None else grad
+        torch.nn.utils.clip_grad_norm_(trainable, args.grad_clip)
+        opt.step()
+        opt.zero_grad()
+
+    sync = torch.distributed.barrier if world_size > 1 else (lambda: None)
+    step()
+    sync()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    sync()
+    if rank == 0:
+        results.put((world_size, (time.time() - start) / steps, grad.numpy()))  # by value, the process exits
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
+
+
+def bench_ddp(args, steps=3):
+    """ Time of a train.py step (fixed global --batch-size) over 1/2/4/8 gloo CPU processes with the speedup over
+    one, and the first averaged prompt gradient against the single process one (equal for losses without random
+    attack starts). Each process gets cores // world_size threads, so speedups need a host with spare cores.
+    """
+    import torch.multiprocessing as mp
+    args.freeze_backbone = True
+    results = mp.get_context('spawn').SimpleQueue()
+    # every process gets cores // world_size intra-op threads: without spare cores there is nothing to gain
+    print('{} on {} CPU cores, global batch {}'.format(args.model, os.cpu_count(), args.batch_size))
+    for world_size in [1, 2, 4, 8]:
+        if args.batch_size % world_size:
+            continue
+        workers = mp.spawn(ddp_worker, args=(args, world_size, 29500 + world_size, steps, results), nprocs=world_size,
+                           join=False)
+        _, step_time, grad = results.get()  # before joining, rank 0 blocks on the pipe until it is read
+        while not workers.join():
+            pass
+        grad = torch.from_numpy(grad)
+        if world_size == 1:
+            base_time, base_grad = step_time, grad
+        print('{} processes: {:.3f}s per step, {:.1f} img/s, speedup {:.2f}, max |prompt grad diff| {:.1e}'.format(
+            world_size, step_time, args.batch_size / step_time, base_time / step_time, (grad - base_grad).abs().max().item()))
+
+
+BENCHES = {
+    'frozen': bench_frozen,
+    'skip_restarts': bench_skip_restarts,
+    'methods': bench_methods,
+    'prefix_kv': bench_prefix_kv,
+    'attn': bench_attn,
+    'cpu_eval': bench_cpu_eval,
+    'fold_norm': bench_fold_norm,
+    'pgd_step': bench_pgd_step,
+    'data': bench_data,
+    'ckpt': bench_ckpt,
+    'startup': bench_startup,
+    'multitask': bench_multitask,
+    'serve': bench_serve,
+    'sweep': bench_sweep,
+    'ddp': bench_ddp,
+}
+
+if __name__ == '__main__':
+    bench_parser = argparse.ArgumentParser()
+    bench_parser.add_argument('--bench', choices=list(BENCHES), required=True)
+    bench_parser.add_argument('--methods', nargs='+', default=['ADAPT', 'ADAPT_NFGSM'])
+    bench_args = bench_parser.parse_known_args()[0]
+    bench = bench_args.bench
+    args = get_args()
+    args.methods = bench_args.methods
+    setup_device(args)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    BENCHES[bench](args)
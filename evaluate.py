@@ -3,30 +3,40 @@ import torch.nn as nn
 import torch.nn.functional as F
 from utils import *
 import numpy as np
-from attacks import CW_loss, attack_cw, attack_pgd
+import time
+import os
+import hashlib
+import itertools
+from attacks import CW_loss, attack_cw, attack_pgd, attack_pgd_skip_restarts, embed_clean, perturbed, pgd_restart_pool
 from torchvision import datasets, transforms
 from autoattack import AutoAttack
+from collections import namedtuple
 # from utils import normalize
 # installing AutoAttack by: pip install git+https://github.com/fra31/auto-attack
 
 
 
-def evaluate_aa(args, model,test_loader,log_path,aa_batch=128, prompt=None):
-    if args.dataset=="cifar":
-        mu = torch.tensor(cifar10_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar10_std).view(3,1,1).cuda()
-    if args.dataset=='cifar100':
-        mu = torch.tensor(cifar100_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar100_std).view(3,1,1).cuda()
-    if args.dataset=="imagenette" or args.dataset=="imagenet":
-        mu = torch.tensor(imagenet_mean).view(3,1,1).cuda()
-        std = torch.tensor(imagenet_std).view(3,1,1).cuda()
-    epsilon = (args.epsilon / 255.) / std.mean().item()
-    model.eval()
-    l = [x for (x, y) in test_loader]
-    x_test = torch.cat(l, 0)
-    l = [y for (x, y) in test_loader]
-    y_test = torch.cat(l, 0)
+# one attack of evaluate_attacks, kind is natural/pgd/cw/aa, alpha in /255 pixel units,
+# unadapt attacks the model without the prompt (the prompted model is still evaluated)
+AttackSpec = namedtuple('AttackSpec', ['name', 'kind', 'iters', 'restarts', 'alpha', 'unadapt'])
+
+def eval_specs(args):
+    """ the attacks of eval_adv """
+    specs = [AttackSpec('clean', 'natural', 0, 0, 0, False)]
+    if args.unadapt:
+        specs += [AttackSpec('adaptive fgsm', 'pgd', 1, 1, 2 * args.epsilon, False),
+                  AttackSpec('adaptive pgd10', 'pgd', 10, 1, 2, False)]
+    specs += [AttackSpec('fgsm', 'pgd', 1, 1, 2 * args.epsilon, args.unadapt),
+              AttackSpec('pgd10', 'pgd', 10, 1, 2, args.unadapt)]
+    if not args.unadapt:
+        specs += [AttackSpec('cw', 'cw', 20, 1, 2, False),
+                  AttackSpec('aa', 'aa', 0, 0, 0, False)]
+    return specs
+
+def get_aa(args, model, log_path, prompt=None):
+    g = get_geometry(args)
+    # AutoAttack takes one scalar: the pixel epsilon over the mean std, as before the per-channel geometry
+    epsilon = g.epsilon if g.fold_norm else (args.epsilon / 255.) / g.std.mean().item()
     class normalize_model():
         def __init__(self, model, prompt=None, deep=False):
             self.model_test = model
@@ -35,23 +45,295 @@ def evaluate_aa(args, model,test_loader,log_path,aa_batch=128, prompt=None):
         def __call__(self, x):
             return self.model_test(x, self.prompt, deep=self.deep)
     new_model = normalize_model(model, prompt, args.deep_p)
-    adversary = AutoAttack(new_model, norm='Linf', eps=epsilon, version='standard',log_path=log_path)
-    X_adv = adversary.run_standard_evaluation(x_test, y_test, bs=aa_batch)
+    return AutoAttack(new_model, norm='Linf', eps=epsilon, version='standard',log_path=log_path, device=args.device)
+
+def aa_shard_key(args, model, prompt=None):
+    """ what the --aa-shards results depend on: the model and data (model_fingerprint), epsilon and the eval subset """
+    return hashlib.sha256(repr((model_fingerprint(args, model, prompt), args.epsilon, args.deep_p, args.num_eval,
+                                args.seed, args.aa_shards)).encode()).hexdigest()
+
+def aa_shard_rows(n, i, shards):
+    # shard i of the eval set: a contiguous slice, the same for every process and job
+    return slice(i * n // shards, (i + 1) * n // shards)
+
+def evaluate_aa(args, model, test_loader, root, shard_ids, logger, prompt=None):
+    """ AutoAttack on the --aa-shards slices shard_ids of the eval set (the TensorLoader of get_eval_set).
+    root/shard{i}of{n}.pt holds the dataset index, clean and robust flags and float16 adversarial deltas of the
+    slice, rewritten after every --AA-batch chunk: a preempted shard resumes at its first unfinished chunk and a
+    finished one is skipped, unless it belongs to another aa_shard_key. AutoAttack logs to root/shard{i}of{n}.log.
+    """
+    model.eval()
+    os.makedirs(root, exist_ok=True)
+    key = aa_shard_key(args, model, prompt)
+    n = len(test_loader.images)
+    for i in shard_ids:
+        path = os.path.join(root, 'shard{}of{}'.format(i, args.aa_shards))
+        shard = test_loader.subset(aa_shard_rows(n, i, args.aa_shards))
+        shard.batch_size = args.AA_batch
+        state = torch.load(path + '.pt') if os.path.exists(path + '.pt') else None
+        if state is None or state['key'] != key:
+            size = len(shard.images)
+            state = {'key': key, 'done': 0, 'index': shard.index.clone(), 'clean': torch.zeros(size, dtype=torch.bool),
+                     'robust': torch.zeros(size, dtype=torch.bool), 'delta': None}
+            if os.path.exists(path + '.log'):
+                os.remove(path + '.log')
+        if state['done'] == len(state['index']):
+            logger.info('AutoAttack shard {}/{} already done'.format(i, args.aa_shards))
+            continue
+        logger.info('AutoAttack shard {}/{}: {} samples from {}'.format(i, args.aa_shards, len(state['index']), state['done']))
+        adversary = get_aa(args, model, path + '.log', prompt=prompt)
+        start = 0
+        for X, y in shard.batches(indexed=False):
+            rows = slice(start, start + y.size(0))
+            start += y.size(0)
+            if rows.stop <= state['done']:
+                continue
+            X_adv = adversary.run_standard_evaluation(X, y, bs=args.AA_batch)
+            with torch.no_grad():
+                state['clean'][rows] = (model(X, prompt, deep=args.deep_p).max(1)[1] == y).cpu()
+                state['robust'][rows] = (model(X_adv, prompt, deep=args.deep_p).max(1)[1] == y).cpu()
+            if state['delta'] is None:
+                state['delta'] = torch.zeros(len(state['index']), *X.shape[1:], dtype=torch.float16)
+            state['delta'][rows] = (X_adv - X).half().cpu()
+            state['done'] = rows.stop
+            save_atomic(lambda tmp: torch.save(state, tmp), path + '.pt')
+
+def merge_aa_shards(args, root, key, log_path):
+    """ Robust accuracy over every --aa-shards slice once all are finished with this key (None otherwise).
+    Deterministic whatever process wrote which shard: shards are read in order, the merged flags are sorted by
+    dataset index into root/merged.pt, log_path gets the per-shard and total accuracies followed by the shard logs.
+    """
+    parts = []
+    for i in range(args.aa_shards):
+        path = os.path.join(root, 'shard{}of{}'.format(i, args.aa_shards))
+        if not os.path.exists(path + '.pt'):
+            return None
+        part = torch.load(path + '.pt')
+        if part['key'] != key or part['done'] < len(part['index']):
+            return None
+        parts.append(part)
+    lines = ['shard {}/{}: {} samples, clean acc {:.4f}, robust acc {:.4f}'.format(
+        i, args.aa_shards, len(p['index']), p['clean'].float().mean().item(), p['robust'].float().mean().item())
+        for i, p in enumerate(parts)]
+    index = torch.cat([p['index'] for p in parts])
+    order = index.argsort()
+    clean, robust = [torch.cat([p[k] for p in parts])[order] for k in ('clean', 'robust')]
+    lines.append('total: {} samples, clean acc {:.4f}, robust acc {:.4f}'.format(
+        len(index), clean.float().mean().item(), robust.float().mean().item()))
+    merged = {'key': key, 'index': index[order], 'clean': clean, 'robust': robust}
+    save_atomic(lambda tmp: torch.save(merged, tmp), os.path.join(root, 'merged.pt'))
+
+    def write_log(tmp):  # several processes may merge the same finished set at once
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            for i in range(args.aa_shards):
+                shard_log = os.path.join(root, 'shard{}of{}.log'.format(i, args.aa_shards))
+                if os.path.exists(shard_log):
+                    with open(shard_log) as g:
+                        f.write('\n#### shard {}/{}\n'.format(i, args.aa_shards) + g.read())
+    save_atomic(write_log, log_path)
+    return robust.float().mean().item()
+
+def attack_spec(args, model, X, y, spec, prompt=None, clean=None, adversary=None):
+    """ delta of one AttackSpec on a device batch """
+    g = get_geometry(args)
+    attack_prompt = prompt if not spec.unadapt else None
+    if spec.kind == 'pgd' and args.eval_skip_restarts:
+        return attack_pgd_skip_restarts(model, X, y, g.epsilon, g.scale(spec.alpha), spec.iters, spec.restarts,
+                                        g.lower_limit, g.upper_limit, prompt=attack_prompt, deep=args.deep_p, clean=clean,
+                                        retire=not spec.unadapt)[0]
+    if spec.kind == 'pgd':
+        return attack_pgd(model, X, y, g.epsilon, g.scale(spec.alpha), spec.iters, spec.restarts, g.lower_limit, g.upper_limit,
+                          prompt=attack_prompt, deep=args.deep_p, clean=clean, restart_batch=args.restart_batch).detach()
+    if spec.kind == 'cw':
+        return attack_cw(model, X, y, g.epsilon, g.scale(spec.alpha), spec.iters, spec.restarts, g.lower_limit, g.upper_limit,
+                         prompt=attack_prompt, deep=args.deep_p, num_cls=g.num_cls, clean=clean)
+    if spec.kind == 'aa':
+        return adversary.run_standard_evaluation(X, y, bs=args.AA_batch) - X
+    raise ValueError(spec.kind)
+
+def model_fingerprint(args, model, prompt=None):
+    """ sha256 of what a trained checkpoint changes (prompt, head and patch embedding, every weight for FT),
+    of the base weights under it (args.base_fingerprint) and of the data the model sees, the key of EvalCache
+    """
+    h = hashlib.sha256(repr((args.model, args.params, args.scratch, args.base_fingerprint, args.dataset, args.resize,
+                             args.crop, args.fold_norm)).encode())
+    m = unwrap_model(model)
+    state = m.state_dict() if args.params == 'FT' else {**{'head.' + k: v for k, v in m.head.state_dict().items()},
+                                                       **{'patch_embed.' + k: v for k, v in m.patch_embed.state_dict().items()}}
+    if prompt is not None:
+        state['prompt'] = prompt
+    for k in sorted(state):
+        h.update(k.encode())
+        h.update(state[k].detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+class EvalCache():
+    """ Per-sample outcomes of evaluate_attacks on disk, one file per (model fingerprint, AttackSpec, attack settings:
+    epsilon, deep_p, --eval-skip-restarts, --restart-batch) mapping dataset index -> (correct, loss). Samples already attacked are never attacked again, so a larger
+    --num-eval or an interrupted run only pays for the new samples. refresh ignores what is on disk.
+    The processes of a distributed run each keep the file of their shard.
+    """
+    def __init__(self, root, fingerprint, args, refresh=False):
+        self.root = root
+        self.fingerprint = fingerprint
+        # everything else that changes an attack's outcome: the restart noise depends on how restarts are batched
+        self.attack_config = (args.epsilon, args.deep_p, args.eval_skip_restarts, args.restart_batch)
+        self.refresh = refresh
+        self.shard = '' if args.world_size == 1 else '.shard{}of{}'.format(args.rank, args.world_size)
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, spec):
+        key = repr((self.fingerprint, spec.kind, spec.iters, spec.restarts, spec.alpha, spec.unadapt, self.attack_config))
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest()[:32] + self.shard + '.pt')
 
+    def load(self, spec):
+        path = self.path(spec)
+        if self.refresh or not os.path.exists(path):
+            return {}
+        saved = torch.load(path)
+        return dict(zip(saved['index'].tolist(), zip(saved['correct'].tolist(), saved['loss'].tolist())))
+
+    def save(self, spec, outcomes):
+        index = sorted(outcomes)
+        path = self.path(spec)
+        torch.save({'spec': spec._asdict(), 'index': torch.tensor(index),
+                    'correct': torch.tensor([outcomes[i][0] for i in index]),
+                    'loss': torch.tensor([outcomes[i][1] for i in index])}, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+def evaluate_attacks(args, model, test_loader, specs, logger, prompt=None, log_path=None, cascade=False, cache=None):
+    """ Every AttackSpec in one pass over test_loader: each batch is moved to the device and embedded once and the
+    clean forward is shared. Returns {spec name: {'loss', 'acc', 'attacked', 'cached', 'time'}}: mean loss over the
+    evaluated samples (CW loss for cw specs, CE otherwise), robust accuracy, fraction of samples evaluated, fraction
+    of samples taken from the EvalCache and seconds spent.
+    With cascade the specs run in order on the samples that survived all earlier ones (clean errors included), so
+    'acc' is the accuracy against that spec and every cheaper one, the AutoAttack stage gives the worst case.
+    A sample broken by a cheap attack may survive a later one, so these are not the per-spec accuracies of the
+    default pass, which stays the way to get those.
+    cache (an EvalCache, needs the TensorLoader of get_eval_set) skips samples with a stored outcome.
+    --eval-skip-restarts runs pgd specs with attack_pgd_skip_restarts (same accuracy, cw specs run in full).
+    AutoAttack runs per batch and prints its reports, log_path gets one summary over the whole set.
+    """
+    model.eval()
+    g = get_geometry(args)
+    outcomes = {s.name: cache.load(s) if cache is not None and s.kind != 'natural' else {} for s in specs}
+    adversary = get_aa(args, model, None, prompt=prompt) if any(s.kind == 'aa' for s in specs) else None
+    totals = {s.name: {'loss': 0., 'acc': 0, 'attacked': 0, 'cached': 0, 'time': 0.} for s in specs}
+    n = 0
+    logger.info('Evaluating {}{}'.format(', '.join(s.name for s in specs), ' as a cascade' if cascade else ''))
+    for step, batch in enumerate(test_loader.batches(indexed=True) if cache is not None else test_loader):
+        X, y = batch[0].to(args.device), batch[1].to(args.device)
+        index = batch[2].tolist() if cache is not None else None
+        start = time.time()
+        with torch.no_grad():
+            clean = embed_clean(model, X) if args.reuse_embed else None
+            out_clean = perturbed(model, X, None, prompt, deep=args.deep_p, clean=clean)
+        keep = torch.ones_like(y, dtype=torch.bool)
+        for s in specs:
+            t = totals[s.name]
+            known = outcomes[s.name]
+            use = keep if cascade else torch.ones_like(keep)
+            hit = torch.tensor([i in known for i in index], device=y.device) if known else torch.zeros_like(keep)
+            hit &= use
+            run = use & ~hit
+            correct = torch.zeros_like(keep)
+            loss = torch.zeros(y.shape, device=y.device)
+            if hit.any():
+                cached = [known[i] for i, h in zip(index, hit.tolist()) if h]
+                correct[hit] = torch.tensor([c for c, _ in cached], device=y.device)
+                loss[hit] = torch.tensor([l for _, l in cached], device=y.device)
+            if run.any():
+                Xr, yr = X[run], y[run]
+                cr = clean[run] if clean is not None else None
+                if s.kind == 'natural':
+                    output = out_clean[run]
+                else:
+                    delta = attack_spec(args, model, Xr, yr, s, prompt=prompt, clean=cr, adversary=adversary)
+                    with torch.no_grad():
+                        output = perturbed(model, Xr, delta, prompt, deep=args.deep_p, clean=cr)
+                correct[run] = output.max(1)[1] == yr
+                loss[run] = CW_loss(output, yr, reduction=False, num_cls=g.num_cls) if s.kind == 'cw' else F.cross_entropy(output, yr, reduction='none')
+                if cache is not None and s.kind != 'natural':
+                    for i, c, l in zip(torch.tensor(index)[run.cpu()].tolist(), correct[run].tolist(), loss[run].tolist()):
+                        known[i] = (c, l)
+            t['loss'] += loss[use].sum().item()
+            t['acc'] += correct[use].sum().item()
+            t['attacked'] += use.sum().item()
+            t['cached'] += hit.sum().item()
+            t['time'] += time.time() - start
+            start = time.time()
+            if cascade:
+                keep &= correct
+        n += y.size(0)
+        if (step + 1) % 10 == 0 or step + 1 == len(test_loader):
+            logger.info('{}/{} {}'.format(step+1, len(test_loader), {name: t['acc'] / n for name, t in totals.items()}))
+            if cache is not None:
+                for s in specs:
+                    if s.kind != 'natural':
+                        cache.save(s, outcomes[s.name])
+    # counts and sums over the processes of a distributed run, times stay per process
+    sums = all_sum(args, n, *[t[k] for t in totals.values() for k in ('loss', 'acc', 'attacked', 'cached')])
+    n = sums[0]
+    for i, t in enumerate(totals.values()):
+        t['loss'], t['acc'], t['attacked'], t['cached'] = sums[1 + 4 * i:5 + 4 * i]
+    results = {name: {'loss': t['loss'] / max(t['attacked'], 1), 'acc': t['acc'] / n, 'attacked': t['attacked'] / n,
+                      'cached': t['cached'] / n, 'time': t['time']} for name, t in totals.items()}
+    aa_specs = [s for s in specs if s.kind == 'aa']
+    if aa_specs and log_path is not None and args.rank == 0:
+        clean_acc = [results[s.name]['acc'] for s in specs if s.kind == 'natural']
+        with open(log_path, 'w') as f:
+            f.write('AutoAttack standard Linf, epsilon {}/255, {} samples\n'.format(args.epsilon, n))
+            if clean_acc:
+                f.write('clean accuracy: {:.2%}\n'.format(clean_acc[0]))
+            for s in aa_specs:
+                f.write('{} {}robust accuracy: {:.2%}{}\n'.format(s.name, 'cumulative ' if cascade else '', results[s.name]['acc'],
+                        '' if not cascade else ' (cascade: {:.2%} attacked, the survivors of every earlier attack)'.format(
+                            results[s.name]['attacked'])))
+    return results
 
 def evaluate_natural(args, model, test_loader, logger, prompt=None):
     model.eval()
     with torch.no_grad():
         test_loss = test_acc = test_n = 0
         for step, (X_batch, y_batch) in enumerate(test_loader):
-            X, y = X_batch.cuda(), y_batch.cuda()
+            X, y = X_batch.to(args.device), y_batch.to(args.device)
             output = model(X, prompt, deep=args.deep_p)
             loss = F.cross_entropy(output, y)
             test_loss += loss.item() * y.size(0)
             test_acc += (output.max(1)[1] == y).float().mean() * y.size(0)
             test_n += y.size(0)
+    test_loss, test_acc, test_n = all_sum(args, test_loss, test_acc, test_n)
     return test_loss/test_n, test_acc/test_n
 
+def evaluate_skip_restarts(args, model, test_loader, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit,
+                           eval_steps=None, prompt=None, unadapt=False):
+    """ evaluate_pgd with pgd_restart_pool: the robust accuracy of --restart-batch 1, samples fooled for good skip
+    the remaining restarts and count the loss of their max-loss delta so far, and the rows they free are refilled
+    from the next batches. With unadapt every restart runs.
+    """
+    def batches():
+        for X, y in itertools.islice(test_loader, eval_steps):
+            X, y = X.to(args.device), y.to(args.device)
+            with torch.no_grad():
+                clean = embed_clean(model, X) if args.reuse_embed else None
+            yield X, y, clean
+
+    total_loss = total_acc = n = attacked = 0
+    for X, y, clean, delta, k in pgd_restart_pool(model, batches(), epsilon, alpha, attack_iters, restarts, lower_limit,
+                                                  upper_limit, test_loader.batch_size,
+                                                  prompt=prompt if not unadapt else None, deep=args.deep_p,
+                                                  retire=not unadapt):
+        with torch.no_grad():
+            output = perturbed(model, X, delta, prompt, deep=args.deep_p, clean=clean)
+            total_loss += F.cross_entropy(output, y, reduction='sum').item()
+            total_acc += (output.max(1)[1] == y).sum().item()
+            n += y.size(0)
+            attacked += k
+    total_loss, total_acc, n, attacked = all_sum(args, total_loss, total_acc, n, attacked)
+    print('Skip restarts: ran {:.2f} of {} restarts per sample'.format(attacked / n, restarts), total_loss/n, total_acc/n)
+    return total_loss/n, total_acc/n
+
 def evaluate_pgd(args, model, test_loader, eval_steps=None, prompt=None, unadapt=False):
     attack_iters = args.eval_iters # 50
     restarts = args.eval_restarts # 10
@@ -59,25 +341,20 @@ def evaluate_pgd(args, model, test_loader, eval_steps=None, prompt=None, unadapt
     pgd_acc = 0
     n = 0
     print('Evaluating with PGD {} steps and {} restarts'.format(attack_iters, restarts))
-    if args.dataset=="cifar":
-        mu = torch.tensor(cifar10_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar10_std).view(3,1,1).cuda()
-    if args.dataset=='cifar100':
-        mu = torch.tensor(cifar100_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar100_std).view(3,1,1).cuda()
-    if args.dataset=="imagenette" or args.dataset=="imagenet":
-        mu = torch.tensor(imagenet_mean).view(3,1,1).cuda()
-        std = torch.tensor(imagenet_std).view(3,1,1).cuda()
-    upper_limit = ((1 - mu)/ std)
-    lower_limit = ((0 - mu)/ std)
-    epsilon = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon, alpha = g.epsilon, g.scale(args.alpha)
+    if args.eval_skip_restarts:
+        return evaluate_skip_restarts(args, model, test_loader, epsilon, alpha, attack_iters, restarts, lower_limit,
+                                      upper_limit, eval_steps=eval_steps, prompt=prompt, unadapt=unadapt)
     for step, (X, y) in enumerate(test_loader):
-        X, y = X.cuda(), y.cuda()
+        X, y = X.to(args.device), y.to(args.device)
+        with torch.no_grad():
+            clean = embed_clean(model, X) if args.reuse_embed else None
         pgd_delta = attack_pgd(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit, 
-                prompt=prompt if not unadapt else None, deep=args.deep_p).detach()
+                prompt=prompt if not unadapt else None, deep=args.deep_p, clean=clean, restart_batch=args.restart_batch).detach()
         with torch.no_grad():
-            output = model(X + pgd_delta, prompt, deep=args.deep_p)
+            output = perturbed(model, X, pgd_delta, prompt, deep=args.deep_p, clean=clean)
             loss = F.cross_entropy(output, y)
             pgd_loss += loss.item() * y.size(0)
             pgd_acc += (output.max(1)[1] == y).sum().item()
@@ -87,6 +364,7 @@ def evaluate_pgd(args, model, test_loader, eval_steps=None, prompt=None, unadapt
         if (step + 1) % 10 == 0 or step + 1 == len(test_loader):
             print('{}/{}'.format(step+1, len(test_loader)), 
                 pgd_loss/n, pgd_acc/n)
+    pgd_loss, pgd_acc, n = all_sum(args, pgd_loss, pgd_acc, n)
     return pgd_loss/n, pgd_acc/n
 
 def evaluate_CW(args, model, test_loader, eval_steps=None, prompt=None, unadapt=False):
@@ -97,28 +375,18 @@ def evaluate_CW(args, model, test_loader, eval_steps=None, prompt=None, unadapt=
     n = 0
     model.eval()
     print('Evaluating with CW {} steps and {} restarts'.format(attack_iters, restarts))
-    if args.dataset=="cifar":
-        num_cls = 10
-        mu = torch.tensor(cifar10_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar10_std).view(3,1,1).cuda()
-    if args.dataset=="imagenette" or args.dataset=="imagenet":
-        num_cls = 10 if args.dataset=="imagenette" else 1000 
-        mu = torch.tensor(imagenet_mean).view(3,1,1).cuda()
-        std = torch.tensor(imagenet_std).view(3,1,1).cuda()
-    if args.dataset=='cifar100':
-        num_cls = 100
-        mu = torch.tensor(cifar100_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar100_std).view(3,1,1).cuda()
-    upper_limit = ((1 - mu)/ std)
-    lower_limit = ((0 - mu)/ std)
-    epsilon = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+    g = get_geometry(args)
+    num_cls = g.num_cls
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon, alpha = g.epsilon, g.scale(args.alpha)
     for step, (X, y) in enumerate(test_loader):
-        X, y = X.cuda(), y.cuda()
+        X, y = X.to(args.device), y.to(args.device)
+        with torch.no_grad():
+            clean = embed_clean(model, X) if args.reuse_embed else None
         delta = attack_cw(model, X, y, epsilon, alpha, attack_iters, restarts, lower_limit, upper_limit,
-                 prompt=prompt if not unadapt else None, deep=args.deep_p, num_cls=num_cls)
+                 prompt=prompt if not unadapt else None, deep=args.deep_p, num_cls=num_cls, clean=clean)
         with torch.no_grad():
-            output = model(X + delta, prompt, deep=args.deep_p)
+            output = perturbed(model, X, delta, prompt, deep=args.deep_p, clean=clean)
             loss = CW_loss(output, y)
             cw_loss += loss.item() * y.size(0)
             cw_acc += (output.max(1)[1] == y).sum().item()
@@ -127,4 +395,5 @@ def evaluate_CW(args, model, test_loader, eval_steps=None, prompt=None, unadapt=
         if (step + 1) % 10 == 0 or step + 1 == len(test_loader):
             print('{}/{}'.format(step+1, len(test_loader)),
                 cw_loss/n, cw_acc/n)
+    cw_loss, cw_acc, n = all_sum(args, cw_loss, cw_acc, n)
     return cw_loss/n, cw_acc/n
\ No newline at end of file
@@ -1,121 +1,123 @@
-from attacks import attack_pgd
+from attacks import PGDState, attack_pgd, embed_clean, init_delta, perturbed
 import torch.nn.functional as F
 from utils import *
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
+from collections import namedtuple
 
-def mu_std(args):   
-    if args.dataset == 'cifar':
-        mu = torch.tensor(cifar10_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(cifar10_std).view(3, 1, 1).cuda()
-    elif args.dataset == 'cifar100':
-        mu = torch.tensor(cifar100_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(cifar100_std).view(3, 1, 1).cuda()
-    elif args.dataset == 'imagenette':
-        mu = torch.tensor(imagenet_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(imagenet_std).view(3, 1, 1).cuda()
-    return mu, std
-
-def natural(model, prompt, X, y, args):
+# out_clean is the prompted clean output when the loss computes it, None otherwise
+LossResult = namedtuple('LossResult', ['loss', 'out_adv', 'out_clean'])
+
+def weighted(beta, loss, reduction='mean'):
+    """ beta * loss(reduction). beta may also hold one weight per sample (sweep.py stacks members with their own
+    beta), the per-sample losses loss('none') are then weighted before the batch mean.
+    """
+    if not torch.is_tensor(beta):
+        return beta * loss(reduction)
+    per_sample = loss('none')
+    return (beta * per_sample.view(per_sample.size(0), -1).sum(1)).mean()
+
+def natural(model, prompt, X, y, args, store=None, idx=None):
     out = model(X, prompt)
     loss = F.cross_entropy(out, y)
 
-    return loss, out
+    return LossResult(loss, out, out)
 
-def AT(model, prompt, X, y, args):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon_base = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+def AT(model, prompt, X, y, args, store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base, alpha = g.epsilon, g.alpha
 
-    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit).detach()
-    out = model(X + delta, prompt)
+    clean = embed_clean(model, X) if args.reuse_embed else None
+    delta_init = store.load(idx, init_delta(X, epsilon_base, lower_limit, upper_limit)) if store is not None else None
+
+    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit, clean=clean,
+                       delta_init=delta_init).detach()
+    if store is not None:
+        store.save(idx, delta)
+    out = perturbed(model, X, delta, prompt, clean=clean)
     loss = F.cross_entropy(out, y)
-    return loss, out
-
-def TRADES(model, prompt, X, y, args):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon_base = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+    return LossResult(loss, out, None)
+
+def TRADES(model, prompt, X, y, args, store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base, alpha = g.epsilon, g.alpha
     beta = args.beta
-    epsilon = epsilon_base.cuda()
+    epsilon = epsilon_base
+    clean = embed_clean(model, X) if args.reuse_embed else None
+    clean_d = clean.detach() if clean is not None else None
     
-    if args.delta_init == 'random':
-        delta = 0.001 * torch.randn(X.shape).cuda()
-        delta.data = clamp(delta, lower_limit - X, upper_limit - X)
+    if args.delta_init == 'zero':
+        delta = torch.zeros_like(X)
+    else:
+        delta = 0.001 * torch.randn(X.shape).to(X.device)
+    if store is not None:
+        delta = store.load(idx, delta)
+    state = PGDState(X, epsilon, alpha, lower_limit, upper_limit)
+    delta = state.reset(delta)
     model.eval()
 
-    delta.requires_grad = True
-
+    with torch.no_grad():
+        p_clean = F.softmax(perturbed(model, X, None, clean=clean_d), dim=1)
     for _ in range(args.attack_iters):
-        loss_kl = F.kl_div(F.log_softmax(model(X + delta), dim=1),
-                                F.softmax(model(X), dim=1), reduction='batchmean')
+        loss_kl = F.kl_div(F.log_softmax(perturbed(model, X, delta, clean=clean_d), dim=1),
+                                p_clean, reduction='batchmean')
         grad = torch.autograd.grad(loss_kl, [delta])[0]
-        delta.data = clamp(delta + alpha * torch.sign(grad), -epsilon, epsilon)
-        delta.data = clamp(delta, lower_limit - X, upper_limit - X)
+        state.step(grad)
 
     delta = delta.detach()
+    if store is not None:
+        store.save(idx, delta)
 
-    outc = model(X, prompt)
-    outa = model(X + delta, prompt)
+    outc = perturbed(model, X, None, prompt, clean=clean)
+    outa = perturbed(model, X, delta, prompt, clean=clean)
 
     loss_natural = F.cross_entropy(outc, y)
-    loss_robust = F.kl_div(F.log_softmax(outa, dim=1),
-                                                    F.softmax(outc, dim=1), reduction='batchmean')
-    loss = loss_natural + beta * loss_robust
-    return loss, outa
-
-def NFGSM(model, prompt, X, y, args):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
-    eta = torch.zeros_like(X).cuda()
-    for j in range(len(epsilon)):
-        eta[:, j, :, :].uniform_(-2.0*epsilon[j][0][0].item(), 2.0*epsilon[j][0][0].item())
-    eta = torch.clamp(eta, lower_limit - X, upper_limit - X)
-    eta.requires_grad = True
+    loss_robust = lambda r: F.kl_div(F.log_softmax(outa, dim=1), F.softmax(outc, dim=1), reduction=r)
+    loss = loss_natural + weighted(beta, loss_robust, 'batchmean')
+    return LossResult(loss, outa, outc)
+
+def NFGSM(model, prompt, X, y, args, store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon, alpha = g.epsilon, g.alpha
+    state = PGDState(X, 2.0 * epsilon, alpha, lower_limit, upper_limit, project=False)
+    eta = state.reset()
 
     output = model(X + eta)
     loss = F.cross_entropy(output, y)
     grad = torch.autograd.grad(loss, eta)[0]
-    grad = grad.detach()
     # Compute perturbation based on sign of gradient
-    delta = eta + alpha * torch.sign(grad)
-
-    delta = torch.clamp(delta, lower_limit - X, upper_limit - X)
-    delta = delta.detach()
+    delta = state.step(grad).detach()
     
     output = model(X + delta, prompt)
     loss = F.cross_entropy(output, y)
-    return loss, output
-
-def MART(model, prompt, X, y, args, distance='l_inf'):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon_base = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+    return LossResult(loss, output, None)
+
+def MART(model, prompt, X, y, args, distance='l_inf', store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base, alpha = g.epsilon, g.alpha
     kl = nn.KLDivLoss(reduction='none')
     model.eval()
     batch_size = X.size(0)
     beta = args.beta
     # generate adversarial example
-    x_adv = X.detach() + 0.001 * torch.randn(X.shape).cuda().detach()
+    x_adv = X.detach() + 0.001 * torch.randn(X.shape).to(X.device).detach()
     if distance == 'l_inf':
+        # steps on x_adv - X, projected to the epsilon ball and then [0, 1]
+        state = PGDState(X, epsilon_base, alpha, 0., 1.)
+        delta = state.delta
+        with torch.no_grad():
+            delta.copy_(x_adv - X)
         for _ in range(args.attack_iters):
-            x_adv.requires_grad_()
             with torch.enable_grad():
-                loss_ce = F.cross_entropy(model(x_adv), y)
-            grad = torch.autograd.grad(loss_ce, [x_adv])[0]
-            x_adv = x_adv.detach() + alpha * torch.sign(grad.detach())
-            x_adv = torch.min(torch.max(x_adv, X - epsilon_base), X + epsilon_base)
-            x_adv = torch.clamp(x_adv, 0.0, 1.0)
+                loss_ce = F.cross_entropy(model(X + delta), y)
+            grad = torch.autograd.grad(loss_ce, [delta])[0]
+            state.step(grad)
+        x_adv = torch.clamp(X + delta.detach(), 0.0, 1.0)
     else:
         x_adv = torch.clamp(x_adv, 0.0, 1.0)
     model.train()
@@ -138,50 +140,135 @@ def MART(model, prompt, X, y, args, distance='l_inf'):
 
     true_probs = torch.gather(nat_probs, 1, (y.unsqueeze(1)).long()).squeeze()
 
-    loss_robust = (1.0 / batch_size) * torch.sum(
-        torch.sum(kl(torch.log(adv_probs + 1e-12), nat_probs), dim=1) * (1.0000001 - true_probs))
-    loss = loss_adv + float(beta) * loss_robust
+    robust = torch.sum(kl(torch.log(adv_probs + 1e-12), nat_probs), dim=1) * (1.0000001 - true_probs)
+    loss_robust = lambda r: robust if r == 'none' else (1.0 / batch_size) * torch.sum(robust)
+    loss = loss_adv + weighted(beta if torch.is_tensor(beta) else float(beta), loss_robust)
 
-    return loss, logits_adv
+    return LossResult(loss, logits_adv, logits)
 
-def ADAPT_CE(model, prompt, X, y, args):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon_base = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+def ADAPT_CE(model, prompt, X, y, args, store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base, alpha = g.epsilon, g.alpha
+
+    clean = embed_clean(model, X) if args.reuse_embed else None
+    delta_init = store.load(idx, init_delta(X, epsilon_base, lower_limit, upper_limit)) if store is not None else None
 
     ## Adaptive Attack
-    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit, prompt=prompt).detach()
+    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit, prompt=prompt, clean=clean,
+                       delta_init=delta_init).detach()
+    if store is not None:
+        store.save(idx, delta)
 
     ## Prompted model output
-    outc = model(X, prompt)
-    outa = model(X + delta, prompt)
+    outc = perturbed(model, X, None, prompt, clean=clean)
+    outa = perturbed(model, X, delta, prompt, clean=clean)
 
     ## loss
-    loss = F.cross_entropy(outc, y) + args.beta * F.cross_entropy(outa, y)
-    return loss, outa
-
-def ADAPT_KL(model, prompt, X, y, args):
-    mu, std = mu_std(args)
-    upper_limit = ((1 - mu) / std).cuda()
-    lower_limit = ((0 - mu) / std).cuda()
-    epsilon_base = (args.epsilon / 255.) / std
-    alpha = (args.alpha / 255.) / std
+    loss = F.cross_entropy(outc, y) + weighted(args.beta, lambda r: F.cross_entropy(outa, y, reduction=r))
+    return LossResult(loss, outa, outc)
+
+def ADAPT_KL(model, prompt, X, y, args, store=None, idx=None):
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base, alpha = g.epsilon, g.alpha
     beta = args.beta
+    clean = embed_clean(model, X) if args.reuse_embed else None
+    delta_init = store.load(idx, init_delta(X, epsilon_base, lower_limit, upper_limit)) if store is not None else None
     
     ## Adaptive Attack
-    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit, prompt=prompt)
+    delta = attack_pgd(model, X, y, epsilon_base, alpha, args.attack_iters, 1, lower_limit, upper_limit, prompt=prompt, clean=clean,
+                       delta_init=delta_init)
 
     delta = delta.detach()
+    if store is not None:
+        store.save(idx, delta)
+
+    ## Prompted Output
+    outc = perturbed(model, X, None, prompt, clean=clean)
+    outa = perturbed(model, X, delta, prompt, clean=clean)
+
+    ## Loss
+    loss_natural = F.cross_entropy(outc, y)
+    loss_robust = lambda r: F.kl_div(F.log_softmax(outa, dim=1), F.softmax(outc, dim=1), reduction=r)
+    loss = loss_natural + weighted(beta, loss_robust, 'batchmean')
+    return LossResult(loss, outa, outc)
+
+
+def ADAPT_NFGSM(model, prompt, X, y, args, store=None, idx=None):
+    """ Single-step ADAPT: N-FGSM (noise in 2 eps, one FGSM step of --nfgsm-step, eps by default, no projection
+    back to eps) computed through the prompted model, then the ADAPT CE/KL objective.
+    """
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon = g.epsilon
+    step = epsilon if args.nfgsm_step is None else g.scale(args.nfgsm_step)
+    beta = args.beta
+    clean = embed_clean(model, X) if args.reuse_embed else None
+
+    ## Prompt-conditioned single step
+    state = PGDState(X, 2.0 * epsilon, step, lower_limit, upper_limit, project=False)
+    eta = state.reset()
+    output = perturbed(model, X, eta, prompt, clean=clean.detach() if clean is not None else None)
+    loss = F.cross_entropy(output, y)
+    grad = torch.autograd.grad(loss, eta)[0]
+    delta = state.step(grad).detach()
 
     ## Prompted Output
-    outc = model(X, prompt)
-    outa = model(X + delta, prompt)
+    outc = perturbed(model, X, None, prompt, clean=clean)
+    outa = perturbed(model, X, delta, prompt, clean=clean)
 
     ## Loss
     loss_natural = F.cross_entropy(outc, y)
-    loss_robust = F.kl_div(F.log_softmax(outa, dim=1),
-                                                    F.softmax(outc, dim=1), reduction='batchmean')
-    loss = loss_natural + beta * loss_robust
-    return loss, outa
+    if args.adapt_loss == 'ce':
+        loss_robust = lambda r: F.cross_entropy(outa, y, reduction=r)
+        reduction = 'mean'
+    else:
+        loss_robust = lambda r: F.kl_div(F.log_softmax(outa, dim=1), F.softmax(outc, dim=1), reduction=r)
+        reduction = 'batchmean'
+    loss = loss_natural + weighted(beta, loss_robust, reduction)
+    return LossResult(loss, outa, outc)
+
+class FreeDelta():
+    """ Perturbation carried across the replays (and minibatches) of free adversarial training.
+    The backward of the loss leaves the input gradient in delta.grad, the sign step of size alpha is taken at the next replay.
+    """
+    def __init__(self):
+        self.delta = None
+
+    def __call__(self, X, epsilon, alpha, lower_limit, upper_limit):
+        if self.delta is None or self.delta.size(0) < X.size(0):
+            self.delta = torch.zeros_like(X, requires_grad=True)
+        elif self.delta.grad is not None:
+            delta = clamp(self.delta + alpha * torch.sign(self.delta.grad), -epsilon, epsilon)
+            self.delta = delta.detach().requires_grad_(True)
+        return clamp(self.delta[:X.size(0)], lower_limit - X, upper_limit - X)
+
+def ADAPT_FREE(model, prompt, X, y, args, store=None, idx=None):
+    """ ADAPT objective with "free" adversarial training: train_adv replays each minibatch args.free_replays
+    times and one backward gives both the prompt/head gradients and the delta step (--free-step, eps by default),
+    store is a FreeDelta.
+    """
+    g = get_geometry(args)
+    upper_limit, lower_limit = g.upper_limit, g.lower_limit
+    epsilon_base = g.epsilon
+    step = epsilon_base if args.free_step is None else g.scale(args.free_step)
+    beta = args.beta
+    clean = embed_clean(model, X) if args.reuse_embed else None
+
+    delta = store(X, epsilon_base, step, lower_limit, upper_limit)
+
+    ## Prompted Output
+    outc = perturbed(model, X, None, prompt, clean=clean)
+    outa = perturbed(model, X, delta, prompt, clean=clean)
+
+    ## Loss
+    loss_natural = F.cross_entropy(outc, y)
+    if args.adapt_loss == 'ce':
+        loss_robust = lambda r: F.cross_entropy(outa, y, reduction=r)
+        reduction = 'mean'
+    else:
+        loss_robust = lambda r: F.kl_div(F.log_softmax(outa, dim=1), F.softmax(outc, dim=1), reduction=r)
+        reduction = 'batchmean'
+    loss = loss_natural + weighted(beta, loss_robust, reduction)
+    return LossResult(loss, outa, outc)
@@ -1,66 +1,122 @@
 import torch.nn as nn
 import torch
+import hashlib
+from utils import DATASET_STATS, get_geometry, save_atomic, unwrap_model
+
+def load_state_dict(model, state_dict, strict=True):
+    # checkpoints saved from nn.DataParallel carry a 'module.' prefix
+    state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+    return unwrap_model(model).load_state_dict(state_dict, strict=strict)
+
+def base_fingerprint(model):
+    """ sha256 over names, shapes and the bytes of every weight of a freshly built model except the
+    (randomly initialized) head, identifies the base a compact checkpoint overlays
+    """
+    h = hashlib.sha256()
+    for k, v in unwrap_model(model).state_dict().items():
+        if k.startswith('head.'):
+            continue
+        h.update('{}{}'.format(k, tuple(v.shape)).encode())
+        h.update(v.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+def trainable_state(args, model):
+    """ the weights a run can change: the head, the patch embedding when trained or folded, everything for FT """
+    state = unwrap_model(model).state_dict()
+    if args.params == 'FT':
+        return state
+    prefixes = ('head.',) + (('patch_embed.',) if args.train_patch or args.fold_norm else ())
+    return {k: v for k, v in state.items() if k.startswith(prefixes)}
+
+def save_checkpoint(args, path, model, prompt, opt, epoch):
+    """ --ckpt-format full: the whole model; compact: trainable_state plus the base fingerprint, for
+    get_model_prompt to overlay on the base model. Written with save_atomic.
+    """
+    to_save = {'epoch': epoch, 'opt': opt.state_dict(), 'prompt': [prompt], 'fold_norm': args.fold_norm}
+    if args.ckpt_format == 'compact':
+        to_save.update({'format': 'compact', 'base': args.base_fingerprint, 'state_dict': trainable_state(args, model)})
+    else:
+        to_save['state_dict'] = model.state_dict()
+    save_atomic(lambda tmp: torch.save(to_save, tmp), path)
+
+@torch.no_grad()
+def fold_normalization(model, geometry):
+    """ Fold (x - mu) / std into the patch embedding so the model takes [0, 1] pixels:
+    W' = W / std and b' = b - sum(W' * mu) over the input channels and the kernel.
+    """
+    proj = unwrap_model(model).patch_embed.proj
+    mu, std = geometry.mu.view(1, 3, 1, 1), geometry.std.view(1, 3, 1, 1)
+    proj.weight.div_(std)
+    proj.bias.sub_((proj.weight * mu).sum((1, 2, 3)))
 
 def get_model(args):
-    if args.dataset == 'cifar':
-        nclasses = 10
-    elif args.dataset == 'cifar100':
-        nclasses = 100
-    elif args.dataset == 'imagenette':
-        nclasses = 10
+    nclasses = DATASET_STATS[args.dataset][2]
     if args.model == "vit_base_patch16_224":
         from vit import vit_base_patch16_224
-        model = vit_base_patch16_224(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args).cuda()
-        model = nn.DataParallel(model)
+        model = vit_base_patch16_224(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args, prefix_kv=args.prefix_kv, attn_impl=args.attn_impl)
     elif args.model == "vit_large_patch16_224_in21k":
         from vit import vit_large_patch16_224_in21k
-        model = vit_large_patch16_224_in21k(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args).cuda()
-        model = nn.DataParallel(model)
+        model = vit_large_patch16_224_in21k(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args, prefix_kv=args.prefix_kv, attn_impl=args.attn_impl)
     elif args.model == "vit_base_patch16_224_in21k":
         from vit import vit_base_patch16_224_in21k
-        model = vit_base_patch16_224_in21k(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args).cuda()
-        model = nn.DataParallel(model)
+        model = vit_base_patch16_224_in21k(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args, prefix_kv=args.prefix_kv, attn_impl=args.attn_impl)
     elif args.model == "vit_small_patch16_224":
         from vit import  vit_small_patch16_224
-        model = vit_small_patch16_224(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args).cuda()
-        model = nn.DataParallel(model)
+        model = vit_small_patch16_224(pretrained = (not args.scratch),img_size=args.crop,num_classes =nclasses,patch_size=args.patch, args=args, prefix_kv=args.prefix_kv, attn_impl=args.attn_impl)
     else:
         raise ValueError("Model doesn't exist!")
-    return model
+    # one device per process, several devices (or CPU processes) through torchrun, see setup_device
+    return model.to(args.device)
 
 
 
 def get_model_prompt(args):
     model = get_model(args)
-
+    args.base_fingerprint = base_fingerprint(model)
     
     def make_prompt(length, h_dim, depth=1,init_xavier=True):
-        prompt = torch.zeros(1, length, h_dim, depth, requires_grad=True)
-        prompt.cuda()
+        prompt = torch.zeros(1, length, h_dim, depth, device=args.device, requires_grad=True)
         if init_xavier:
             nn.init.xavier_uniform_(prompt)
         return prompt
     checkpoint = None
     if args.load:
-        checkpoint = torch.load(args.load_path)
-        model.load_state_dict(checkpoint['state_dict'])
+        checkpoint = torch.load(args.load_path, map_location=args.device)
+        if checkpoint.get('format') == 'compact':
+            if checkpoint['base'] != args.base_fingerprint:
+                raise ValueError('{} was trained on other base weights than this --model'.format(args.load_path))
+            result = load_state_dict(model, checkpoint['state_dict'], strict=False)
+            if result.unexpected_keys:
+                raise ValueError('unexpected keys in {}: {}'.format(args.load_path, result.unexpected_keys))
+            # the base supplies every other weight, the trained ones have to come from the checkpoint
+            missing = [k for k in result.missing_keys if k in trainable_state(args, model)]
+            if missing:
+                raise ValueError('{} lacks the trained weights {}'.format(args.load_path, missing))
+        else:
+            load_state_dict(model, checkpoint['state_dict'])
+        if args.params != 'FT' and checkpoint.get('prompt', [None])[0] is None:
+            raise ValueError('{} has no prompt'.format(args.load_path))
         epoch_s = checkpoint['epoch']
         opt_dict = checkpoint['opt']
+        if checkpoint.get('fold_norm', False) and not args.fold_norm:
+            raise ValueError('{} has the normalization folded into the patch embedding, run with --fold-norm'.format(args.load_path))
     else:
         epoch_s = 0
         opt_dict = None
-    if args.params ==' PT':
+    if args.fold_norm and not (checkpoint is not None and checkpoint.get('fold_norm', False)):
+        fold_normalization(model, get_geometry(args))
+    if args.params == 'PT':
         if args.load:
             prompt = (checkpoint['prompt'])[0]
         else:
-            prompt = make_prompt(args.prompt_length, model.module.embed_dim, depth=args.prompt_depth)
+            prompt = make_prompt(args.prompt_length, unwrap_model(model).embed_dim, depth=args.prompt_depth)
         params = [prompt]
             
     elif args.params == 'P2T':
         if args.load:
             prompt = (checkpoint['prompt'])[0]
         else:
-            prompt = make_prompt(args.prompt_length, model.module.embed_dim, depth=model.module.depth)        
+            prompt = make_prompt(args.prompt_length, unwrap_model(model).embed_dim, depth=unwrap_model(model).depth)        
         params = [prompt]
 
     if args.params == 'FT':  
@@ -69,9 +125,14 @@ def get_model_prompt(args):
         params = model.parameters()
     else:
         if args.train_patch:
-            for p in model.module.patch_embed.parameters():
+            for p in unwrap_model(model).patch_embed.parameters():
                 params.append(p)
         if not args.freeze_head:
-            for p in model.module.head.parameters():
+            for p in unwrap_model(model).head.parameters():
                 params.append(p)
+        if args.freeze_backbone:
+            # only the prompt/head/patch are optimized, stop autograd from computing the rest
+            model.requires_grad_(False)
+            for p in params:
+                p.requires_grad_(True)
     return model, prompt, params, epoch_s, opt_dict
\ No newline at end of file
@@ -3,8 +3,13 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, default='vit_base_patch16_224')
     parser.add_argument('--method', type=str, default='AT',
-                        choices=['AT', 'TRADES', 'MART', 'natural', 'ADAPT', 'NFGSM'])
+                        choices=['AT', 'TRADES', 'MART', 'natural', 'ADAPT', 'NFGSM', 'ADAPT_FREE', 'ADAPT_NFGSM'])
     parser.add_argument('--adapt-loss', choices=['kl', 'ce'], default='kl')
+    parser.add_argument('--nfgsm-step', type=float, default=None,
+                        help='ADAPT_NFGSM step in /255 pixels, defaults to --epsilon as in N-FGSM')
+    parser.add_argument('--free-replays', type=int, default=4, help='minibatch replays for ADAPT_FREE')
+    parser.add_argument('--free-step', type=float, default=None,
+                        help='ADAPT_FREE step per replay in /255 pixels, defaults to --epsilon as in free adversarial training')
     parser.add_argument('--params', type=str, default='PT', choices=['FT', 'PT', 'P2T'])
     parser.add_argument('--dataset', type=str, default="cifar10", choices= ['cifar10','cifar100', 'imagenette'])
     parser.add_argument('--grad-clip', type=float, default=1.0)
@@ -17,7 +22,9 @@ def get_args():
     parser.add_argument('--resize', type=int, default=32)
     parser.add_argument('--load', action='store_true')
     parser.add_argument('--load_path', default='', type=str)
+    parser.add_argument('--ckpt-format', default='compact', choices=['compact', 'full'], help='compact: trainable tensors only, full: whole model')
     parser.add_argument('--scratch', action='store_true')
+    parser.add_argument('--weight-store', default='', type=str, help='directory of filtered pretrained weights, memory-mapped (off when empty)')
     parser.add_argument('--n_w', type=int, default=10)
     parser.add_argument('--attack-iters', type=int, default=10, help='for pgd training')
     parser.add_argument('--patch', type=int, default=16)
@@ -25,10 +32,15 @@ def get_args():
     parser.add_argument('--lr-schedule', type=str, default='cyclic', choices=['cyclic', 'drops'])
     parser.add_argument('--unadapt', action='store_true')
     parser.add_argument('--freeze-head', action='store_true')
+    parser.add_argument('--freeze-backbone', action='store_true', help='no weight grads for untrained ViT params (PT/P2T)')
     parser.add_argument('--prompt_length', type=int, default=25)
     parser.add_argument('--eval-bb', action='store_true')
     parser.add_argument('--eval-en', action='store_true')
     parser.add_argument('--deep-p', action='store_true')
+    parser.add_argument('--reuse-embed', action='store_true', help='embed X once per batch, attacks only embed delta')
+    parser.add_argument('--attn-impl', default='math', choices=['math', 'sdpa'], help='attention backend')
+    parser.add_argument('--fold-norm', action='store_true', help='fold input normalization into the patch embedding, attack in [0,1] pixels')
+    parser.add_argument('--prefix-kv', action='store_true', help='compute P2T prompt keys/values once per forward')
     parser.add_argument('--n_query', type=int, default=10000, help='blackbox attack queries')
     parser.add_argument('--num-eval', type=int, default=10000, help='how many samples to eval')
     parser.add_argument('--train-patch', action='store_true')
@@ -36,7 +48,22 @@ def get_args():
     parser.add_argument("--just-eval", action='store_true')
     parser.add_argument('--eval-restarts', type=int, default=1)
     parser.add_argument('--eval-iters', type=int, default=10)
+    parser.add_argument('--eval-skip-restarts', action='store_true',
+                        help='PGD eval: skip the remaining restarts of samples the attack already fooled for good, '
+                             'same accuracy as --restart-batch 1')
+    parser.add_argument('--eval-cascade', action='store_true',
+                        help='--just-eval: attack only the samples that survived the cheaper attacks, reports cumulative '
+                             'accuracies instead of the per-attack ones of the default evaluation')
+    parser.add_argument('--eval-cache', default='', type=str, help='directory for --just-eval per-sample results (off when empty)')
+    parser.add_argument('--refresh', action='store_true', help='recompute and overwrite the --eval-cache entries')
+    parser.add_argument('--aa-shards', type=int, default=0,
+                        help='--just-eval: only AutoAttack, on this many deterministic slices of the eval set (0: in eval_adv)')
+    parser.add_argument('--aa-shard', type=int, default=-1,
+                        help='the --aa-shards slice of this job, -1 for every unfinished one (dealt out by rank under torchrun)')
+    parser.add_argument('--aa-merge', action='store_true', help='only merge the finished --aa-shards results')
+    parser.add_argument('--restart-batch', type=int, default=1, help='PGD restarts stacked per pass, 0 for all')
     parser.add_argument('--data-dir', default='../../datasets/', type=str)
+    parser.add_argument('--data-cache', default='', type=str, help='directory for decoded uint8 splits, batched augmentation without workers')
     parser.add_argument('--epochs', default=40, type=int)
     parser.add_argument('--lr-min', default=0., type=float)
     parser.add_argument('--lr-max', default=0.1, type=float)
@@ -48,6 +75,13 @@ def get_args():
                         help='Perturbation initialization method')
     parser.add_argument('--out-dir', '--dir', default='./outs/', type=str, help='Output directory')
     parser.add_argument('--model_log', action='store_true')
+    parser.add_argument('--device', default='auto', type=str, help='auto, cpu, cuda or cuda:N')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op CPU threads, 0 keeps the torch default')
+    parser.add_argument('--interop-threads', default=0, type=int, help='inter-op CPU threads, 0 keeps the torch default')
+    parser.add_argument('--dist-backend', default='gloo', choices=['gloo', 'nccl'],
+                        help='process group backend when launched with torchrun (gloo also runs on CPU)')
+    parser.add_argument('--dist-timeout', type=float, default=240,
+                        help='minutes a process waits at a collective, e.g. while rank 0 builds a cache')
     parser.add_argument('--seed', default=0, type=int, help='Random seed')
     parser.add_argument('--name', type=str, default='sample_run')
 
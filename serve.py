@@ -0,0 +1,207 @@
+#### Micro-batching inference server for a prompt checkpoint
+## usage: python serve.py --model vit_base_patch16_224 --params P2T --load --load_path ./checkpoint --port 8000
+## POST /predict with an image file as the body -> {"label": ..., "logits": [...]}
+## GET /metrics -> request count, p50/p99 latency (ms) and the batch size histogram
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from parser import get_args
+from model import get_model_prompt
+from utils import get_geometry, setup_device
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class Batcher():
+    """ Coalesces single-image requests into batches of at most max_batch, closing a batch max_latency seconds
+    after its first request arrived. The forward runs in a worker thread, so requests keep queueing meanwhile.
+    """
+    def __init__(self, args, model, prompt, max_batch, max_latency, window=10000):
+        self.args, self.model, self.prompt = args, model, prompt
+        self.geometry = get_geometry(args)
+        self.max_batch, self.max_latency = max_batch, max_latency
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen=window)  # seconds from arrival to result, last window requests
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+
+    async def predict(self, x):
+        """ logits of one uint8 (3, H, W) image """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((x, future, time.perf_counter()))
+        return await future
+
+    @torch.inference_mode()
+    def forward(self, X):
+        X = self.geometry.to_model(X.to(self.args.device).float().div_(255))
+        return self.model(X, self.prompt, deep=self.args.deep_p).float().cpu()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                out = await loop.run_in_executor(None, self.forward, torch.stack([x for x, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            self.requests += len(batch)
+            for (_, future, start), logits in zip(batch, out):
+                self.latencies.append(now - start)
+                if not future.done():
+                    future.set_result(logits)
+
+    def metrics(self):
+        lat = np.array(self.latencies) * 1000
+        return {
+            'requests': self.requests,
+            'batches': sum(self.batch_sizes.values()),
+            'latency_ms': {'p50': float(np.percentile(lat, 50)) if len(lat) else None,
+                           'p99': float(np.percentile(lat, 99)) if len(lat) else None},
+            'batch_size_hist': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+        }
+
+
+def get_transform(args):
+    """ the eval transform of get_loaders: resized uint8 images """
+    return transforms.Compose([transforms.Resize([args.resize, args.resize]), transforms.PILToTensor()])
+
+
+async def handle(reader, writer, batcher, transform):
+    loop = asyncio.get_running_loop()
+    decode = lambda body: transform(Image.open(io.BytesIO(body)).convert('RGB'))
+    try:
+        while True:  # keep-alive: one request per iteration
+            line = await reader.readline()
+            if not line.strip():
+                break
+            method, path, _ = line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                key, value = header.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if method == 'POST' and path == '/predict':
+                try:
+                    x = await loop.run_in_executor(None, decode, body)
+                except Exception as e:
+                    status, payload = 400, {'error': 'cannot decode image: {}'.format(e)}
+                else:
+                    try:
+                        logits = await batcher.predict(x)
+                    except Exception as e:  # the batch forward failed, e.g. out of memory: the connection stays usable
+                        status, payload = 500, {'error': 'inference failed: {}'.format(e)}
+                    else:
+                        status, payload = 200, {'label': int(logits.argmax()), 'logits': logits.tolist()}
+            elif method == 'GET' and path == '/metrics':
+                status, payload = 200, batcher.metrics()
+            else:
+                status, payload = 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+            data = json.dumps(payload).encode()
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                status, REASONS[status], len(data)).encode('latin-1') + data)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(args, model, prompt, host, port, max_batch, max_latency):
+    """ returns the listening asyncio server, its batcher and the batcher task """
+    batcher = Batcher(args, model, prompt, max_batch, max_latency)
+    task = asyncio.create_task(batcher.run())
+    transform = get_transform(args)
+    server = await asyncio.start_server(lambda r, w: handle(r, w, batcher, transform), host, port)
+    return server, batcher, task
+
+
+async def load_test(host, port, images, concurrency, requests):
+    """ concurrency keep-alive clients posting the encoded images round robin until requests are answered.
+    Returns the wall time and the client side latencies (seconds).
+    """
+    latencies, sent = [], iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in sent:
+            body = images[i % len(images)]
+            start = time.perf_counter()
+            writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                host, len(body)).encode('latin-1') + body)
+            await writer.drain()
+            await reader.readline()
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b''):
+                    break
+                key, value = header.decode('latin-1').split(':', 1)
+                if key.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - start, latencies
+
+
+def random_images(args, n, seed=0):
+    """ n random PNG encoded images of the run's input size """
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(n):
+        buf = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, (args.resize, args.resize, 3), dtype=np.uint8)).save(buf, format='PNG')
+        images.append(buf.getvalue())
+    return images
+
+
+if __name__ == '__main__':
+    serve_parser = argparse.ArgumentParser()
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--max-batch', type=int, default=32)
+    serve_parser.add_argument('--max-latency-ms', type=float, default=10., help='batching window after the first request')
+    serve_args = serve_parser.parse_known_args()[0]
+    args = get_args()
+    setup_device(args)
+    torch.manual_seed(args.seed)
+    model, prompt, _, _, _ = get_model_prompt(args)
+    model.eval()
+
+    async def main():
+        server, _, _ = await start_server(args, model, prompt, serve_args.host, serve_args.port,
+                                          serve_args.max_batch, serve_args.max_latency_ms / 1000)
+        print('serving on http://{}:{}'.format(serve_args.host, serve_args.port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,358 @@
+#### Sweep mode: K prompt/head members trained at once, their batches stacked through one frozen backbone
+## usage: python sweep.py --sweep sweep.json --model vit_base_patch16_224_in21k --params P2T --freeze-backbone ...
+## sweep.json is a list of members, each a dict of train.py args overriding the command line,
+## e.g. [{"lr_max": 0.1}, {"lr_max": 1.0, "seed": 1}], or a dict of lists expanded into their grid.
+## Members that only differ in MEMBER_KEYS are trained in one stacked run (one per prompt_length), the other groups
+## one after another. Every member draws its data order, augmentation, attack starts and dropout from its own
+## generators, seeded as in its train.py run, so it reproduces that run up to the float rounding of the stacked
+## batch. The training set is read through --data-cache, in the main process.
+import argparse
+import contextlib
+import copy
+import itertools
+import json
+import logging
+import math
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import wandb
+from torch.overrides import TorchFunctionMode
+import losses
+from parser import get_args
+from model import get_model_prompt, save_checkpoint
+from utils import get_loaders, setup_device, unwrap_model
+from evaluate import evaluate_natural, evaluate_pgd
+
+# optimization and initialization of a member, free to differ inside one stacked run
+MEMBER_KEYS = {'lr_max', 'lr_min', 'lr_schedule', 'optim', 'momentum', 'weight_decay', 'grad_clip', 'seed',
+               'load', 'load_path', 'ckpt_format', 'chkpnt_interval', 'prompt_length', 'beta'}
+# the shared backbone and data, fixed for the whole sweep
+SHARED_KEYS = {'model', 'params', 'dataset', 'crop', 'resize', 'patch', 'scratch', 'fold_norm', 'prefix_kv',
+               'attn_impl', 'train_patch', 'freeze_backbone', 'batch_size', 'num_eval', 'data_dir', 'data_cache',
+               'weight_store', 'device'}
+
+
+class Stack(nn.Module):
+    """ Members through one backbone: the input holds their batches back to back (repeated as a whole for stacked
+    restarts), prompt is the (K, L, D, depth) bank of their prompts and row r belongs to member (r // batch) % K.
+    unwrap_model gives the backbone, as for DataParallel.
+    """
+    def __init__(self, model, heads):
+        super().__init__()
+        self.module = unwrap_model(model)
+        self.heads = nn.ModuleList(heads)
+        self.batch = None  # rows per member, set for every minibatch
+
+    def forward(self, x, prompt=None, deep=False, clean=None):
+        index = torch.arange(x.size(0), device=x.device) // self.batch % len(self.heads)
+        return self.module.forward_multi(x, prompt, index, self.heads, deep=deep, clean=clean)
+
+
+def get_rng(device):
+    return torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+
+
+def set_rng(device, state):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state(state[1], device)
+
+
+@contextlib.contextmanager
+def member_rng(member):
+    """ the global CPU/CUDA generators continue member.rng inside the block, the sweep's own state outside """
+    saved = get_rng(member.device)
+    set_rng(member.device, member.rng)
+    try:
+        yield
+    finally:
+        member.rng = get_rng(member.device)
+        set_rng(member.device, saved)
+
+
+class MemberRNG(TorchFunctionMode):
+    """ Random draws of a stacked loss taken from the members' own generators. A draw over stacked rows (row r of
+    member (r // batch) % K, restarts repeat the whole stack) is split by member, and each member fills its rows in
+    order from member_rng, the same draw of the same size as in its own run. Dropout masks are split the same way.
+    """
+    # the random ops of the losses and attacks, with the in-place fill each one amounts to
+    FILLS = {torch.Tensor.uniform_: torch.Tensor.uniform_, torch.Tensor.normal_: torch.Tensor.normal_,
+             torch.rand: torch.Tensor.uniform_, torch.randn: torch.Tensor.normal_,
+             torch.rand_like: torch.Tensor.uniform_, torch.randn_like: torch.Tensor.normal_}
+
+    def __init__(self, members, batch):
+        super().__init__()
+        self.members, self.batch = members, batch
+
+    def rows(self, n, device):
+        K = len(self.members)
+        if n % (K * self.batch):
+            raise ValueError('a random draw over {} rows is not a stack of {} member batches of {}'.format(
+                n, K, self.batch))
+        owner = torch.arange(n, device=device) // self.batch % K
+        return [(owner == k).nonzero()[:, 0] for k in range(K)]
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in self.FILLS:
+            inplace = func is self.FILLS[func]
+            # a factory is drawn in full from the sweep's generator first, then every member refills its rows
+            out = args[0] if inplace else func(*args, **kwargs)
+            for member, rows in zip(self.members, self.rows(out.size(0), out.device)):
+                part = out.new_empty((len(rows),) + out.shape[1:])
+                with member_rng(member):
+                    if inplace:
+                        func(part, *args[1:], **kwargs)
+                    else:
+                        self.FILLS[func](part)
+                with torch.no_grad():
+                    out[rows] = part
+            return out
+        if func is F.dropout:
+            x, p, training = dropout_args(*args, **kwargs)
+            if not training or p == 0:
+                return func(*args, **kwargs)
+            out = torch.empty_like(x)
+            for member, rows in zip(self.members, self.rows(x.size(0), x.device)):
+                with member_rng(member):
+                    out[rows] = F.dropout(x[rows], p, training)
+            return out
+        return func(*args, **kwargs)
+
+
+def dropout_args(input, p=0.5, training=True, inplace=False):
+    return input, p, training
+
+
+def get_loss_fn(args):
+    if args.method == 'ADAPT':
+        return getattr(losses, 'ADAPT_' + args.adapt_loss.upper())
+    return getattr(losses, args.method)
+
+
+def lr_schedule(args, t):
+    """ train.py's --lr-schedule at epoch t """
+    if args.lr_schedule == 'cyclic':
+        return np.interp([t], [0, args.epochs // 2, args.epochs], [args.lr_min, args.lr_max, args.lr_min])[0]
+    if t < args.epochs - 5:
+        return args.lr_max
+    elif t < args.epochs - 2:
+        return args.lr_max * 0.1
+    return args.lr_max * 0.01
+
+
+def get_members(args, spec):
+    """ one args namespace per member of a --sweep spec, with .tag naming it and .overrides """
+    if isinstance(spec, dict):
+        spec = [dict(zip(spec, values)) for values in itertools.product(*spec.values())]
+    members = []
+    for k, overrides in enumerate(spec):
+        unknown = [key for key in overrides if not hasattr(args, key)]
+        if unknown:
+            raise ValueError('member {}: unknown args {}'.format(k, unknown))
+        shared = [key for key in overrides if key in SHARED_KEYS]
+        if shared:
+            raise ValueError('member {}: {} are shared by the whole sweep, set them on the command line'.format(k, shared))
+        member = copy.copy(args)
+        vars(member).update(overrides)
+        member.geometry = None  # epsilon/alpha may be overridden
+        member.overrides = overrides
+        member.tag = '_'.join('{}{}'.format(key, value) for key, value in overrides.items()) or 'member{}'.format(k)
+        member.out_dir = os.path.join(args.out_dir, 'sweep', member.tag)
+        members.append(member)
+    return members
+
+
+def group_members(members):
+    """ members split by every override outside MEMBER_KEYS, which the stacked loss cannot vary per sample, and
+    bucketed by prompt_length: the prompt bank stacks prompts of one shape
+    """
+    groups = {}
+    for member in members:
+        key = tuple(sorted((k, repr(v)) for k, v in member.overrides.items() if k not in MEMBER_KEYS))
+        key += (member.prompt_length,)
+        groups.setdefault(key, []).append(member)
+    return list(groups.values())
+
+
+def build_group(members, model=None):
+    """ get_model_prompt for every member, under its seed as in train.py, so its initial state is the one of a
+    separate run, and member.rng the generator states the run continues from. The first model built becomes the
+    shared backbone (model, when given), the others only contribute their head.
+    Returns the backbone, the heads, prompts, params, optimizers and the start epoch.
+    """
+    heads, prompts, params, opts, starts = [], [], [], [], []
+    for member in members:
+        np.random.seed(member.seed)
+        torch.manual_seed(member.seed)
+        torch.cuda.manual_seed(member.seed)
+        member_model, prompt, member_params, epoch_s, opt_dict = get_model_prompt(member)
+        member.rng = get_rng(member.device)
+        if model is None:
+            model = member_model
+            model.base_fingerprint = member.base_fingerprint
+        elif member.base_fingerprint != model.base_fingerprint:
+            raise ValueError('{} was built on other backbone weights than the first member, a sweep shares one '
+                             'backbone (use pretrained weights, or one seed with --scratch)'.format(member.tag))
+        member_model.requires_grad_(False)
+        for p in member_params:
+            p.requires_grad_(True)
+        if member.optim == 'sgd':
+            opt = torch.optim.SGD(member_params, lr=member.lr_max, momentum=member.momentum, weight_decay=member.weight_decay)
+        else:
+            opt = torch.optim.Adam(member_params, lr=member.lr_max, weight_decay=member.weight_decay)
+        if opt_dict is not None:
+            opt.load_state_dict(opt_dict)
+        heads.append(unwrap_model(member_model).head)
+        prompts.append(prompt)
+        params.append(member_params)
+        opts.append(opt)
+        starts.append(epoch_s)
+        del member_model
+    if len(set(starts)) > 1:
+        raise ValueError('members resume from different epochs: {}'.format(starts))
+    if len(set(p.shape for p in prompts)) > 1:
+        raise ValueError('members have differently shaped prompts: {}'.format([tuple(p.shape) for p in prompts]))
+    return model, heads, prompts, params, opts, starts[0]
+
+
+def train_step(stack, members, prompts, params, opts, X, y, loss_fn, store=None, replays=1):
+    """ one minibatch of every member, X/y their batches back to back. The stacked loss is the mean of the member
+    losses, so K times it backpropagates each member's own gradient into its prompt and head. Every member's random
+    draws come from its own generators and its robust term is weighted by its own beta.
+    """
+    stack.batch = X.size(0) // len(members)
+    args = members[0]
+    if len(set(m.beta for m in members)) > 1:
+        args = copy.copy(args)
+        args.beta = torch.tensor([float(m.beta) for m in members], device=X.device).repeat_interleave(stack.batch)
+    for _ in range(replays):
+        with MemberRNG(members, stack.batch):
+            loss, out_a, out_c = loss_fn(stack, torch.cat(prompts), X, y, args, store=store)
+        (loss * len(members)).backward()
+        for member, member_params, opt in zip(members, params, opts):
+            torch.nn.utils.clip_grad_norm_(member_params, member.grad_clip)
+            opt.step()
+            opt.zero_grad()
+    if out_c is None:
+        with torch.no_grad():
+            out_c = stack(X, torch.cat(prompts))
+    return loss, out_a.detach(), out_c.detach()
+
+
+def train_group(members, model, train_loader, test_loader, logger):
+    model, heads, prompts, params, opts, epoch_s = build_group(members, model)
+    stack = Stack(model, heads)
+    K = len(members)
+    args = members[0]  # the loss settings besides beta, the same for the whole group
+    loss_fn = get_loss_fn(args)
+    store, replays = None, 1
+    if args.method == 'ADAPT_FREE':
+        replays = args.free_replays
+        store = losses.FreeDelta()
+        for member in members:
+            member.epochs = int(math.ceil(member.epochs / replays))
+    logger.info('Training {} members from epoch {}: {}'.format(K, epoch_s, [m.tag for m in members]))
+    for member in members:
+        os.makedirs(member.out_dir, exist_ok=True)
+
+    loaders = [copy.copy(train_loader) for _ in members]  # TensorLoaders over the one uint8 cache, no workers
+    train_time = 0
+    for epoch in range(epoch_s + 1, args.epochs + 1):
+        epoch_start = time.time()
+        train_loss = 0
+        train_acc = torch.zeros(K)
+        train_clean = torch.zeros(K)
+        train_n = 0
+        stack.train()
+        # every member shuffles and augments its own view of the cached training set, from its own generators
+        epochs = [iter(loader) for loader in loaders]
+        for step in range(len(train_loader)):
+            epoch_now = epoch - 1 + (step + 1) / len(train_loader)
+            batches = []
+            for member, batch in zip(members, epochs):
+                with member_rng(member):
+                    batches.append(next(batch))
+            X = torch.cat([b[0] for b in batches])
+            y = torch.cat([b[1] for b in batches])
+            loss, out_a, out_c = train_step(stack, members, prompts, params, opts, X, y, loss_fn, store=store,
+                                            replays=replays)
+
+            n = y.size(0) // K
+            correct = lambda out: (out.max(1)[1] == y).float().view(K, n).sum(1).cpu()
+            train_loss += loss.item() * n
+            train_acc += correct(out_a)
+            train_clean += correct(out_c)
+            train_n += n
+
+            if (step + 1) % args.log_interval == 0 or step + 1 == len(train_loader):
+                log = {'train adv loss (member mean)': train_loss / train_n}
+                for k, member in enumerate(members):
+                    log.update({member.tag + '/train adv acc': train_acc[k].item() / train_n,
+                                member.tag + '/train clean acc': train_clean[k].item() / train_n,
+                                member.tag + '/lr': opts[k].param_groups[0]['lr']})
+                    logger.info('{} epoch {} step {}/{}, lr {:.4f} adv acc {:.4f} clean acc {:.4f}'.format(
+                        member.tag, epoch, step + 1, len(train_loader), opts[k].param_groups[0]['lr'],
+                        train_acc[k].item() / train_n, train_clean[k].item() / train_n))
+                logger.info('epoch {} step {}/{}, loss (member mean) {:.4f}'.format(
+                    epoch, step + 1, len(train_loader), train_loss / train_n))
+                wandb.log(log)
+            for member, opt in zip(members, opts):
+                opt.param_groups[0].update(lr=lr_schedule(member, epoch_now))
+        train_time += time.time() - epoch_start
+
+        #### CHECKPOINT AND EVALUATE EVERY MEMBER, WITH ITS HEAD ON THE BACKBONE ####
+        log = {'train time': train_time}
+        for k, member in enumerate(members):
+            unwrap_model(model).head = heads[k]
+            if epoch == member.epochs or epoch % member.chkpnt_interval == 0:
+                path = os.path.join(member.out_dir, 'checkpoint_{}'.format(epoch))
+                save_checkpoint(member, path, model, prompts[k], opts[k], epoch)
+                logger.info('{} checkpoint saved to {}'.format(member.tag, path))
+            with member_rng(member):
+                loss_clean, acc_clean = evaluate_natural(member, model, test_loader, logger, prompt=prompts[k])
+                loss_adv, acc_adv = evaluate_pgd(member, model, test_loader, prompt=prompts[k])
+            logger.info('{} natural: loss {:.4f} acc {:.4f}, PGD10: loss {:.4f} acc {:.4f}'.format(
+                member.tag, loss_clean, acc_clean, loss_adv, acc_adv))
+            log.update({member.tag + '/test clean loss': loss_clean, member.tag + '/test adv loss': loss_adv,
+                        member.tag + '/test clean acc': acc_clean, member.tag + '/test adv acc': acc_adv})
+        logger.info('Train time so far {:.1f}s'.format(train_time))
+        wandb.log(log)
+    return model
+
+
+if __name__ == '__main__':
+    sweep_parser = argparse.ArgumentParser()
+    sweep_parser.add_argument('--sweep', required=True, help='json file with the member overrides')
+    sweep_args = sweep_parser.parse_known_args()[0]
+    args = get_args()
+    setup_device(args)
+    with open(sweep_args.sweep) as f:
+        members = get_members(args, json.load(f))
+    if args.params == 'FT' or args.train_patch or not args.freeze_backbone:
+        raise ValueError('a sweep shares a frozen backbone: use --params PT/P2T with --freeze-backbone, without --train-patch')
+    if not args.data_cache:
+        # K DataLoaders would start K x 16 workers, the cached loaders of the members share one uint8 array
+        raise ValueError('a sweep reads the training set through --data-cache')
+    if args.delta_init == 'previous' or any(m.delta_init == 'previous' for m in members):
+        raise ValueError('--delta-init previous is not supported by sweeps')
+
+    os.makedirs(os.path.join(args.out_dir, 'sweep'), exist_ok=True)
+    logging.basicConfig(format='%(levelname)-8s %(asctime)-12s %(message)s', datefmt='%H:%M:%S')
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(os.path.join(args.out_dir, 'sweep', 'log.log'))
+    file_handler.setFormatter(logging.Formatter('%(levelname)-8s %(asctime)-12s %(message)s'))
+    logger.addHandler(file_handler)
+    logger.info(args)
+    wandb.init(project="rpt_cifar", name='sweep_' + os.path.basename(sweep_args.sweep),
+               config=dict(vars(args), members=[m.overrides for m in members]))
+
+    train_loader, test_loader = get_loaders(args)
+    model = None
+    for group in group_members(members):
+        model = train_group(group, model, train_loader, test_loader, logger)
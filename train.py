@@ -1,18 +1,21 @@
 #### Code built upon the repository https://github.com/mo666666/When-Adversarial-Training-Meets-Vision-Transformers
 
 import numpy as np
+import math
+import time
 from parser import get_args
 from utils import *
 from losses import *
-from evaluate import evaluate_aa, evaluate_natural, evaluate_pgd, evaluate_CW
+from evaluate import EvalCache, eval_specs, model_fingerprint, aa_shard_key, evaluate_aa, merge_aa_shards, evaluate_attacks, evaluate_natural, evaluate_pgd, evaluate_CW
 import logging
 import wandb
-from model import get_model_prompt
+from model import get_model_prompt, save_checkpoint
 from torchvision import transforms
 import json
 
 #### PARSE ARGS AND SETUP LOGGING #####
 args = get_args()
+setup_device(args)
 
 joint_p = lambda x, y: torch.cat((x, y), dim=1) if y is not None else x 
 
@@ -29,11 +32,11 @@ args.out_dir = args.out_dir + args.name
 wandb.init(
     project="rpt_cifar",
     name=args.name,
-    config=args
+    config=args,
+    mode=None if args.rank == 0 else 'disabled'
 )
 args.out_dir = args.out_dir +"/seed"+str(args.seed)
 
-print(args.out_dir)
 os.makedirs(args.out_dir,exist_ok=True)
 logfile = os.path.join(args.out_dir, 'log_{:.4f}.log'.format(args.weight_decay))
 logging.basicConfig(
@@ -41,11 +44,16 @@ logging.basicConfig(
     datefmt='%H:%M:%S'
 )
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(logfile)
-file_handler.setFormatter(logging.Formatter('%(levelname)-8s %(asctime)-12s %(message)s'))
-logger.addHandler(file_handler)
+if args.rank == 0:
+    logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(logfile)
+    file_handler.setFormatter(logging.Formatter('%(levelname)-8s %(asctime)-12s %(message)s'))
+    logger.addHandler(file_handler)
+else:
+    # the other processes of a distributed run only report problems
+    logger.setLevel(logging.WARNING)
 
+logger.info('Output directory {}'.format(args.out_dir))
 logger.info(args)
 
 
@@ -68,6 +76,16 @@ elif args.optim == 'adam':
     opt = torch.optim.Adam(params, lr=args.lr_max, weight_decay=args.weight_decay)   
 if opt_dict != None and not (args.just_eval or args.eval_bb or args.eval_en):
     opt.load_state_dict(opt_dict)   
+if args.world_size > 1:
+    if args.params == 'FT' and not (args.just_eval or args.eval_bb or args.eval_en):
+        # all_reduce_grads averages one flat copy of the trained gradients per step, meant for the small prompt/head
+        raise ValueError('distributed training only all-reduces prompt/head gradients, with --params FT every step '
+                         'would all-reduce the whole backbone: fine-tune in a single process')
+    if args.params != 'FT' and not args.freeze_backbone:
+        # without it the backbone gradients of every process enter its own clipping norm
+        raise ValueError('distributed prompt tuning needs --freeze-backbone')
+    # every process starts from the same weights and prompt, attacks and augmentations differ per process
+    torch.manual_seed(args.seed + args.rank)
 
 
 
@@ -91,9 +109,51 @@ def train_adv(args, model, prompt, opt, train_loader, test_loader, logger, epoch
             loss_fn = ADAPT_CE
         elif args.adapt_loss == 'kl':
             loss_fn = ADAPT_KL
+    elif args.method == 'ADAPT_FREE':
+        loss_fn = ADAPT_FREE
+    elif args.method == 'ADAPT_NFGSM':
+        loss_fn = ADAPT_NFGSM
     else:
         raise ValueError(args.method)
     
+    #### PARAMS TO CLIP ####
+    trainable = [p for group in opt.param_groups for p in group['params']]
+    if args.freeze_backbone:
+        clip_params = trainable
+    else:
+        clip_params = list(model.parameters())
+
+    #### WARM-START PERTURBATION STORE ####
+    if args.method == 'ADAPT_FREE' and args.delta_init == 'previous':
+        # free training already carries its perturbation from one minibatch to the next
+        raise ValueError('--method ADAPT_FREE does not take --delta-init previous')
+    store = None
+    if args.delta_init == 'previous':
+        # rank 0 creates the memmaps, the other processes open them and write the rows of their shard
+        store_path = os.path.join(args.out_dir, 'delta_store')
+        if args.rank == 0:
+            store = DeltaStore(store_path, len(train_loader.dataset), (3, args.crop, args.crop), args.epsilon,
+                               args.fold_norm, resume=args.load)
+        if args.world_size > 1:
+            dist.barrier()
+        if args.rank > 0:
+            store = DeltaStore(store_path, len(train_loader.dataset), (3, args.crop, args.crop), args.epsilon,
+                               args.fold_norm, resume=True)
+
+    #### FREE ADVERSARIAL TRAINING: m REPLAYS PER MINIBATCH, EPOCHS SCALED BY 1/m ####
+    replays = 1
+    free = None
+    if args.method == 'ADAPT_FREE':
+        replays = args.free_replays
+        free = FreeDelta()
+        args.epochs = int(math.ceil(args.epochs / replays))
+        step = args.epsilon if args.free_step is None else args.free_step
+        logger.info('Free training with {} replays of step {:g}/255 for {} epochs'.format(replays, step, args.epochs))
+
+    if args.method == 'ADAPT_NFGSM':
+        step = args.epsilon if args.nfgsm_step is None else args.nfgsm_step
+        logger.info('N-FGSM step {:g}/255, noise within 2x{}/255'.format(step, args.epsilon))
+
     #### IF LOADING RESUME EPOCH ####
     if args.load:
         logger.info("Resuming at epoch {}".format(epoch_s))
@@ -111,32 +171,41 @@ def train_adv(args, model, prompt, opt, train_loader, test_loader, logger, epoch
                 return args.lr_max* 0.01
 
     #### TRAIN EPOCHS ####
+    train_time = 0
     for epoch in range(epoch_s + 1, args.epochs + 1):
+        epoch_start = time.time()
         train_loss = 0
         train_acc = 0
         train_clean = 0
         train_n = 0
+        set_epoch(train_loader, epoch)
 
       
         model.train()
         #### EPOCH ####
-        for step, (X, y) in enumerate(train_loader):
+        for step, batch in enumerate(train_loader):
             epoch_now = epoch - 1 + (step + 1) / len(train_loader)
 
-            X = X.cuda()
-            y=y.cuda()
+            X = batch[0].to(args.device)
+            y = batch[1].to(args.device)
+            idx = batch[2] if args.delta_init == 'previous' else None
 
             
-            loss, out_a = loss_fn(model, prompt, X, y, args)
-            opt.zero_grad()
-            model.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(list(model.parameters()) , args.grad_clip)
-            opt.step()
-            opt.zero_grad()
-            model.zero_grad()
-
-            out_c = model(X, prompt).detach()
+            for _ in range(replays):
+                loss, out_a, out_c = loss_fn(model, prompt, X, y, args, store=free if free is not None else store, idx=idx)
+                opt.zero_grad()
+                model.zero_grad()
+                loss.backward()
+                all_reduce_grads(args, trainable)
+                torch.nn.utils.clip_grad_norm_(clip_params, args.grad_clip)
+                opt.step()
+                opt.zero_grad()
+                model.zero_grad()
+
+            if out_c is None:
+                with torch.no_grad():
+                    out_c = model(X, prompt)
+            out_a, out_c = out_a.detach(), out_c.detach()
 
             acc_a = (out_a.max(1)[1] == y).float().mean().item()
             acc_c = (out_c.max(1)[1] == y).float().mean().item()
@@ -164,12 +233,15 @@ def train_adv(args, model, prompt, opt, train_loader, test_loader, logger, epoch
             #### LR SCHEDULE UPDATE ####
             lr = lr_schedule(epoch_now, args.epochs) 
             opt.param_groups[0].update(lr=lr)
+        train_time += time.time() - epoch_start
         path = os.path.join(args.out_dir, 'checkpoint_{}'.format(epoch))
 
         ### SAVE CHECKPOINT ####
         if epoch == args.epochs or epoch % args.chkpnt_interval == 0:
-            to_save = {'state_dict': model.state_dict(), 'epoch': epoch, 'opt': opt.state_dict(), 'prompt': [prompt]}
-            torch.save(to_save, path)
+            if args.rank == 0:
+                save_checkpoint(args, path, model, prompt, opt, epoch)
+            if store is not None:
+                store.flush()
             logger.info('Checkpoint saved to {}'.format(path))
         
         #### EVALUATION EACH EPOCH ####
@@ -181,77 +253,64 @@ def train_adv(args, model, prompt, opt, train_loader, test_loader, logger, epoch
         model.zero_grad()
         logger.info('Natural: loss {:.4f} acc {:.4f}'.format(loss_clean, acc_clean))
         logger.info('PGD10 : loss {:.4f} acc {:.4f}'.format(loss_adv, acc_adv))
+        logger.info('Train time so far {:.1f}s'.format(train_time))
         wandb.log(
             {
                 'test clean loss': loss_clean,
                 'test adv loss': loss_adv,
                 'test clean acc': acc_clean,
-                'test adv acc': acc_adv
+                'test adv acc': acc_adv,
+                'train time': train_time
             }
         )
 
 #### EVALUATE TRAINED MODEL/PROMPT ####
 def eval_adv(args, model, prompt, test_loader, logger):
     model.eval()
-    logger.info('Evaluating natural...')
-    loss_clean, acc_clean = evaluate_natural(args, model, test_loader, logger, prompt=prompt)
-    logger.info('Nat acc {:.4f}'.format(acc_clean))
-    if args.unadapt:
-        logger.info('Evaluating adaptive FGSM...')
-        args.eval_iters = 1
-        args.eval_restarts = 1
-        args.alpha = 2*args.epsilon
-        loss_fgsm, acc_fgsm = evaluate_pgd(args, model, test_loader, prompt=prompt)
-        logger.info('Evaluating adaptive PGD...')
-        args.eval_iters = 10
-        args.eval_restarts = 1
-        args.alpha = 2
-        loss_pgd, acc_pgd = evaluate_pgd(args, model, test_loader, prompt=prompt)
-        logger.info('Moving to traditional attacks...')
-    logger.info('Evaluating FGSM...')
-    args.eval_iters = 1
-    args.eval_restarts = 1
-    args.alpha = 2*args.epsilon
-    loss_fgsm, acc_fgsm = evaluate_pgd(args, model, test_loader, prompt=prompt, unadapt=args.unadapt)
-    logger.info('Evaluating PGD10...')
-    args.eval_iters = 10
-    args.eval_restarts = 1
-    args.alpha = 2
-    loss_pgd, acc_pgd = evaluate_pgd(args, model, test_loader, prompt=prompt, unadapt=args.unadapt)
-    if not args.unadapt:
-        logger.info('Evaluating CW...')
-        loss_cw, acc_cw = evaluate_CW(args, model, test_loader, prompt=prompt, unadapt=args.unadapt)
-        model.zero_grad()
-        aa_path = os.path.join(args.out_dir, 'result_autoattack.txt')
-        _ = evaluate_aa(args, model, test_loader, aa_path, aa_batch=args.AA_batch, prompt=prompt)
-    logger.info({
-            'final clean loss': loss_clean,
-            'final clean acc': acc_clean,
-            'final pgd10 loss': loss_pgd,
-            'final pgd10 acc': acc_pgd,
-            'final fgsm loss': loss_fgsm,
-            'final fgsm acc': acc_fgsm,
-            'final cw loss': loss_cw,
-            'final cw acc': acc_cw,
-        })
-    wandb.log(
-        {
-            'final clean loss': loss_clean,
-            'final clean acc': acc_clean,
-            'final pgd10 loss': loss_pgd,
-            'final pgd10 acc': acc_pgd,
-            'final fgsm loss': loss_fgsm,
-            'final fgsm acc': acc_fgsm,
-            'final cw loss': loss_cw,
-            'final cw acc': acc_cw,
-        }
-    )
+    aa_path = os.path.join(args.out_dir, 'result_autoattack.txt')  # written by rank 0, over every process's samples
+    cache = EvalCache(args.eval_cache, model_fingerprint(args, model, prompt), args, refresh=args.refresh) if args.eval_cache else None
+    results = evaluate_attacks(args, model, test_loader, eval_specs(args), logger, prompt=prompt, log_path=aa_path,
+                               cascade=args.eval_cascade, cache=cache)
+    # a cascade stage only attacks the survivors of the earlier ones: its accuracy is against all of them together
+    acc = 'cumulative acc' if args.eval_cascade else 'acc'
+    for name, r in results.items():
+        logger.info('{}: loss {:.4f} {} {:.4f} attacked {:.2%} (cached {:.2%}) time {:.1f}s'.format(
+            name, r['loss'], acc, r['acc'], r['attacked'], r['cached'], r['time']))
+    if args.eval_cascade:
+        # a stage's cost per attacked sample times the samples it skipped
+        spent = sum(r['time'] for r in results.values())
+        full = sum(r['time'] / r['attacked'] for r in results.values() if r['attacked'] > 0)
+        logger.info('Cascade: {:.1f}s, about {:.1f}s ({:.0%}) saved over attacking every sample'.format(
+            spent, full - spent, 1 - spent / full))
+    final = {'final {} {}'.format(name, acc if k == 'acc' else k): v for name, r in results.items() for k, v in r.items()}
+    logger.info(final)
+    wandb.log(final)
+
+
+def eval_aa_shards(args, model, prompt, test_loader, logger):
+    """ --aa-shards: AutoAttack on this job's shards (--aa-shard, or every shard dealt out by rank), then the merge
+    once every shard is finished. Every process tries the merge when its shards are done, without waiting for the
+    others (an AutoAttack shard can outlast any collective timeout), so the last one to finish completes the set.
+    """
+    if args.aa_shard >= 0 and args.world_size > 1:
+        raise ValueError('--aa-shard picks the shard of a single process job, under torchrun the ranks deal them out')
+    root = os.path.join(args.out_dir, 'aa_shards')
+    if not args.aa_merge:
+        shard_ids = [args.aa_shard] if args.aa_shard >= 0 else list(range(args.rank, args.aa_shards, args.world_size))
+        evaluate_aa(args, model, test_loader, root, shard_ids, logger, prompt=prompt)
+    acc = merge_aa_shards(args, root, aa_shard_key(args, model, prompt), os.path.join(args.out_dir, 'result_autoattack.txt'))
+    if acc is None:
+        logger.info('AutoAttack: shards of {} still running or missing, merge again with --aa-merge'.format(root))
+    else:
+        logger.info('AutoAttack over {} shards: robust acc {:.4f}'.format(args.aa_shards, acc))
+        wandb.log({'final aa acc': acc})
 
 
 def eval_bb(args, model, prompt, test_loader, logger):
     model.eval()
     logger.info('Evaluating with Blackbox attacks')
-    mu, std, n_cls = get_mu_std_ncls(args)
+    g = get_geometry(args)
+    mu, std, n_cls = (None, None, g.num_cls) if g.fold_norm else (g.mu, g.std, g.num_cls)
     epsilon = (args.epsilon / 255.) 
     class normalize_model():
         def __init__(self, model, prompt=None, deep=False):
@@ -275,7 +334,7 @@ def eval_bb(args, model, prompt, test_loader, logger):
     summary_all = ''
     count = 0
     for i, (data, label) in enumerate(test_loader):
-        data, label = data.cuda(), label.cuda()
+        data, label = data.to(args.device), label.to(args.device)
 
         if count >= args.num_eval or i == len(test_loader) - 1:
             break
@@ -315,14 +374,14 @@ def eval_bb(args, model, prompt, test_loader, logger):
 
 def eval_en(args, model, prompt, test_loader, logger):
     model.eval()
-    mu, std, n_cls = get_mu_std_ncls(args)
+    g = get_geometry(args)
     class normalize_model():
         def __init__(self, model, prompt=None, deep=False):
             self.model_test = model
             self.prompt = prompt
             self.deep = deep
         def __call__(self, x):
-            return self.model_test((x - mu)/std, self.prompt, deep=self.deep)
+            return self.model_test(g.to_model(x), self.prompt, deep=self.deep)
         def eval(self):
             self.model_test.eval()
     model_new = normalize_model(model, prompt)
@@ -334,7 +393,7 @@ def eval_en(args, model, prompt, test_loader, logger):
     from AdaEA.utils.get_models import get_models
     from AdaEA.utils.tools import same_seeds, get_project_path
 
-    device = torch.device(f'cuda:0')
+    device = args.device
     models, metrix = get_models(args, device=device)
     ens_model = ['resnet18', 'inc_v3', 'vit_t', 'deit_t']
     print(f'ens model: {ens_model}')
@@ -357,7 +416,9 @@ def eval_en(args, model, prompt, test_loader, logger):
 
 
 ### PERFORM TRAINING/EVALUATION
-if args.just_eval:
+if args.just_eval and args.aa_shards:
+    eval_aa_shards(args, model, prompt, test_loader, logger)
+elif args.just_eval:
     eval_adv(args, model, prompt, test_loader, logger)
 elif args.eval_bb:
     eval_bb(args, model, prompt, test_loader, logger)
@@ -1,14 +1,83 @@
 import torch
 from torchvision import datasets, transforms
-import torch
+import copy
+import datetime
+import json
 import logging
 import os
+import tempfile
+import numpy as np
+import torch.nn.functional as F
+import torch.distributed as dist
 from collections import OrderedDict
 from torch.utils.data.sampler import SubsetRandomSampler
 
 
+def setup_device(args):
+    """ Resolve --device once per run (auto: cuda when available) and apply the CPU thread settings.
+    Under torchrun (WORLD_SIZE > 1) also joins the --dist-backend process group, one process per device:
+    args.rank/args.world_size are set for every run, 0/1 without torchrun.
+    """
+    if args.device == 'auto':
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    args.device = torch.device(args.device)
+    args.rank = int(os.environ.get('RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if args.world_size > 1:
+        if args.device.type == 'cuda':
+            args.device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+            torch.cuda.set_device(args.device)
+        if not dist.is_initialized():
+            dist.init_process_group(args.dist_backend, rank=args.rank, world_size=args.world_size,
+                                    timeout=datetime.timedelta(minutes=args.dist_timeout))
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads > 0:
+        torch.set_num_interop_threads(args.interop_threads)
+    return args.device
+
+
+def all_sum(args, *values):
+    """ values summed over the processes of a distributed run, unchanged in a single process """
+    if args.world_size == 1:
+        return values
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64,
+                     device=args.device if dist.get_backend() == 'nccl' else 'cpu')
+    dist.all_reduce(t)
+    return tuple(t.tolist())
+
+
+def all_reduce_grads(args, params):
+    """ Average the gradients of params over the processes, in one flat all-reduce.
+    Only the trainable prompt/head is reduced, the frozen backbone has no gradients (train.py refuses distributed FT).
+    """
+    if args.world_size == 1:
+        return
+    grads = [p.grad for p in params if p.grad is not None]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat.div_(args.world_size)
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def set_epoch(loader, epoch):
+    # reshuffle the shards of a distributed training loader, identically on every process
+    sampler = getattr(loader, 'sampler', loader)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
+
+
+def unwrap_model(model):
+    # the bare VisionTransformer, also from wrappers keeping it in .module (sweep.Stack, old DataParallel runs)
+    return getattr(model, 'module', model)
+
+
 def clamp(X, lower_limit, upper_limit):
-    return torch.max(torch.min(X, upper_limit), lower_limit)
+    # bounds are both tensors (per-channel/per-sample) or both scalars
+    return torch.clamp(X, lower_limit, upper_limit)
 
 
 cifar10_mean = (0.4914, 0.4822, 0.4465)
@@ -18,59 +87,310 @@ cifar100_std = (0.2673342858792401, 0.2564384629170883, 0.27615047132568404)
 imagenet_mean = (0.485, 0.456, 0.406)
 imagenet_std = (0.229, 0.224, 0.225)
 
+# dataset: (mean, std, number of classes)
+DATASET_STATS = {
+    'cifar10': (cifar10_mean, cifar10_std, 10),
+    'cifar100': (cifar100_mean, cifar100_std, 100),
+    'imagenette': (imagenet_mean, imagenet_std, 10),
+    'imagenet': (imagenet_mean, imagenet_std, 1000),
+}
+
+
+class AttackGeometry():
+    """ Normalization constants and L_inf attack bounds of a run, built once by get_geometry.
+    By default the model takes normalized inputs, so epsilon/alpha and the image box are per-channel (3, 1, 1) tensors.
+    With --fold-norm the normalization lives in the patch embedding and the model takes [0, 1] pixels:
+    epsilon/alpha are python floats and the box is [0, 1].
+    """
+    def __init__(self, args):
+        mean, std, self.num_cls = DATASET_STATS[args.dataset]
+        self.fold_norm = args.fold_norm
+        self.mu = torch.tensor(mean).view(3, 1, 1).to(args.device)
+        self.std = torch.tensor(std).view(3, 1, 1).to(args.device)
+        if self.fold_norm:
+            self.lower_limit, self.upper_limit = 0., 1.
+        else:
+            self.lower_limit = (0 - self.mu) / self.std
+            self.upper_limit = (1 - self.mu) / self.std
+        self.epsilon = self.scale(args.epsilon)
+        self.alpha = self.scale(args.alpha)
+
+    def scale(self, value):
+        """ a perturbation size in /255 pixel units, in the model's input space """
+        if self.fold_norm:
+            return value / 255.
+        return (value / 255.) / self.std
+
+    def to_model(self, X):
+        """ [0, 1] pixels to model inputs """
+        return X if self.fold_norm else (X - self.mu) / self.std
+
+
+def get_geometry(args):
+    if getattr(args, 'geometry', None) is None:
+        args.geometry = AttackGeometry(args)
+    return args.geometry
+
 
 def normalize(args, X):
-    if args.dataset=="cifar10":
-        mu = torch.tensor(cifar10_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(cifar10_std).view(3, 1, 1).cuda()
-    elif args.dataset=='cifar100':
-        mu = torch.tensor(cifar100_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(cifar100_std).view(3, 1, 1).cuda()
-    elif args.dataset=="imagenette" or args.dataset=="imagenet":
-        mu = torch.tensor(imagenet_mean).view(3, 1, 1).cuda()
-        std = torch.tensor(imagenet_std).view(3, 1, 1).cuda()
-    return (X - mu) / std
-
-def get_mu_std_ncls(args):
-    if args.dataset=="cifar10":
-        num_cls = 10
-        mu = torch.tensor(cifar10_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar10_std).view(3,1,1).cuda()
-    if args.dataset=="imagenette" or args.dataset=="imagenet":
-        num_cls = 10 if args.dataset=="imagenette" else 1000 
-        mu = torch.tensor(imagenet_mean).view(3,1,1).cuda()
-        std = torch.tensor(imagenet_std).view(3,1,1).cuda()
-    if args.dataset=='cifar100':
-        num_cls = 100
-        mu = torch.tensor(cifar100_mean).view(3,1,1).cuda()
-        std = torch.tensor(cifar100_std).view(3,1,1).cuda()
-    return mu, std, num_cls
+    g = get_geometry(args)
+    return (X - g.mu) / g.std
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """ Dataset wrapper returning (x, y, index) """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index]
+        return x, y, index
+
+
+class DeltaStore():
+    """ Last adversarial delta of every training sample, a float16 memmap indexed by dataset index.
+    Deltas are stored in augmented coordinates: with RandomCrop/RandomHorizontalFlip the next epoch applies
+    them to a differently cropped/flipped view, so they are only a warm start that the attack re-projects
+    onto the epsilon ball and image box before continuing. path.json records the shape, epsilon and input space
+    (--fold-norm) of the deltas, resuming from a store written for other ones is refused.
+    """
+    def __init__(self, path, n, shape, epsilon, fold_norm, resume=False):
+        header = {'shape': [n, *shape], 'epsilon': epsilon, 'fold_norm': fold_norm}
+        resume = resume and os.path.exists(path + '.f16')
+        if resume:
+            stored = None
+            if os.path.exists(path + '.json'):
+                with open(path + '.json') as f:
+                    stored = json.load(f)
+            if stored != header:
+                raise ValueError('{} holds deltas for {}, this run needs {}: remove it to start a new store'.format(
+                    path, stored, header))
+        else:
+            def save_header(tmp):
+                with open(tmp, 'w') as f:
+                    json.dump(header, f)
+            save_atomic(save_header, path + '.json')
+        mode = 'r+' if resume else 'w+'
+        self.delta = np.memmap(path + '.f16', dtype=np.float16, mode=mode, shape=(n, *shape))
+        self.seen = np.memmap(path + '.seen', dtype=np.bool_, mode=mode, shape=(n,))
+
+    def load(self, idx, fresh):
+        """ stored deltas for idx, fresh (the usual random init) for samples not attacked yet """
+        idx = idx.cpu().numpy()
+        delta = torch.from_numpy(self.delta[idx].astype(np.float32)).to(fresh.device)
+        seen = torch.from_numpy(np.asarray(self.seen[idx])).to(fresh.device)
+        return torch.where(seen[:, None, None, None], delta, fresh)
+
+    def save(self, idx, delta):
+        idx = idx.cpu().numpy()
+        self.delta[idx] = delta.detach().cpu().half().numpy()
+        self.seen[idx] = True
+
+    def flush(self):
+        self.delta.flush()
+        self.seen.flush()
+
+
+def save_atomic(save, path):
+    """ save(tmp) into a temporary file of this process next to path, then rename it to path, so concurrent
+    writers never share a file and readers only see complete ones
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def build_once(path, build):
+    """ build() when path is missing, on rank 0 only in a distributed run: the other processes wait at a barrier
+    and open the finished file afterwards. Every process has to call it.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    if not os.path.exists(path) and (not distributed or dist.get_rank() == 0):
+        build()
+    if distributed:
+        dist.barrier()
+
+
+def cache_split(dataset, path):
+    """ Decode a (PIL image, label) dataset once into path.npy, a (N, 3, H, W) uint8 array, and path.labels.npy """
+    def build():
+        x0, _ = dataset[0]
+        w, h = x0.size
+        labels = np.zeros(len(dataset), dtype=np.int64)
+
+        def save_labels(tmp):
+            with open(tmp, 'wb') as f:
+                np.save(f, labels)
+
+        def save_images(tmp):
+            images = np.lib.format.open_memmap(tmp, dtype=np.uint8, mode='w+', shape=(len(dataset), 3, h, w))
+            for i in range(len(dataset)):
+                x, labels[i] = dataset[i]
+                images[i] = np.asarray(x.convert('RGB'), dtype=np.uint8).transpose(2, 0, 1)
+            images.flush()
+            del images
+            save_atomic(save_labels, path + '.labels.npy')  # before path.npy appears, which marks a complete split
+        save_atomic(save_images, path + '.npy')
+    build_once(path + '.npy', build)
+    return np.load(path + '.npy', mmap_mode='r'), np.load(path + '.labels.npy')
+
+
+class TensorLoader():
+    """ Batches of a uint8 image array (memmap or tensor), decoded once, with crop/flip/normalize as batched
+    tensor ops on the device. Same (X, y[, index]) batches as the DataLoader of get_loaders, in the main process.
+    Without shuffle batches are slices, which stay pinned when images is a pinned tensor.
+    With world_size > 1 every process gets its shard of the rows as with a DistributedSampler: one permutation
+    seeded by seed + set_epoch, padded to a multiple of world_size and dealt out by rank.
+    """
+    def __init__(self, images, labels, batch_size, device, shuffle=False, crop=None, padding=4, flip=False,
+                 mean=None, std=None, indexed=False, index=None, rank=0, world_size=1, seed=0):
+        self.images = images
+        self.index = index  # dataset index of every row, the row number when None
+        self.labels = torch.as_tensor(labels)
+        self.dataset = images  # len(loader.dataset) as with a DataLoader
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.crop = crop
+        self.padding = padding
+        self.flip = flip
+        self.mean = torch.tensor(mean).view(3, 1, 1).to(device) if mean is not None else None
+        self.std = torch.tensor(std).view(3, 1, 1).to(device) if std is not None else None
+        self.indexed = indexed
+        self.rank, self.world_size, self.seed = rank, world_size, seed
+        self.epoch = 0
+
+    def __len__(self):
+        return -(-self.num_rows() // self.batch_size)
+
+    def num_rows(self):
+        # rows of this process
+        return -(-len(self.images) // self.world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def subset(self, rows):
+        """ a loader of the rows slice only, keeping their dataset index """
+        sub = copy.copy(self)
+        sub.images, sub.labels = self.images[rows], self.labels[rows]
+        sub.index = (self.index if self.index is not None else torch.arange(len(self.images)))[rows]
+        sub.dataset = sub.images
+        return sub
+
+    def random_crop(self, X):
+        B, C, H, W = X.shape
+        X = F.pad(X, [self.padding] * 4)
+        oy = torch.randint(0, H + 2 * self.padding - self.crop + 1, (B, 1), device=X.device)
+        ox = torch.randint(0, W + 2 * self.padding - self.crop + 1, (B, 1), device=X.device)
+        rows = (oy + torch.arange(self.crop, device=X.device))[:, None, :, None]
+        cols = (ox + torch.arange(self.crop, device=X.device))[:, None, None, :]
+        return X[torch.arange(B, device=X.device)[:, None, None, None], torch.arange(C, device=X.device)[None, :, None, None], rows, cols]
+
+    def __iter__(self):
+        return self.batches(self.indexed)
+
+    def batches(self, indexed):
+        n = len(self.images)
+        if self.world_size > 1:
+            order = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + self.epoch)) if self.shuffle else torch.arange(n)
+            order = torch.cat([order, order[:self.num_rows() * self.world_size - n]])[self.rank::self.world_size]
+        else:
+            order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for i in range(len(self)):
+            if self.shuffle or self.world_size > 1:
+                # sorted reads are sequential on the memmap, the batch order does not matter
+                idx = order[i * self.batch_size:(i + 1) * self.batch_size].sort()[0]
+                rows = idx if torch.is_tensor(self.images) else idx.numpy()
+            else:
+                idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+                rows = slice(i * self.batch_size, (i + 1) * self.batch_size)
+            X = self.images[rows]
+            X = X if torch.is_tensor(X) else torch.from_numpy(np.array(X))
+            if self.device.type == 'cuda' and not X.is_pinned():
+                X = X.pin_memory()
+            X = X.to(self.device, non_blocking=True).float().div_(255)
+            y = self.labels[idx].to(self.device, non_blocking=True)
+            if self.crop is not None:
+                X = self.random_crop(X)
+            if self.flip:
+                flip = torch.rand(X.size(0), device=X.device) < 0.5
+                X = torch.where(flip[:, None, None, None], X.flip(3), X)
+            if self.mean is not None:
+                X = X.sub_(self.mean).div_(self.std)
+            if not indexed:
+                yield X, y
+            else:
+                yield X, y, idx if self.index is None else self.index[idx]
+
+
+def get_cached_loaders(args, train_dataset, test_dataset):
+    """ get_loaders with --data-cache: both splits decoded once at --resize into uint8 memmaps """
+    mean, std, _ = DATASET_STATS[args.dataset]
+    os.makedirs(args.data_cache, exist_ok=True)
+    resize = transforms.Resize([args.resize, args.resize])
+    train_dataset.transform = test_dataset.transform = resize
+    name = os.path.join(args.data_cache, '{}_{}'.format(args.dataset, args.resize))
+    train_images, train_labels = cache_split(train_dataset, name + '_train')
+    test_images, test_labels = cache_split(test_dataset, name + '_test')
+    train_loader = TensorLoader(train_images, train_labels, args.batch_size // args.world_size, args.device, shuffle=True,
+                                crop=args.crop, flip=True,
+                                mean=None if args.fold_norm else mean, std=None if args.fold_norm else std,
+                                indexed=args.delta_init == 'previous',
+                                rank=args.rank, world_size=args.world_size, seed=args.seed)
+    return train_loader, get_eval_set(args, images=test_images, labels=test_labels)
+
+
+def get_eval_set(args, test_dataset=None, images=None, labels=None):
+    """ The run's evaluation set: a seeded --num-eval subset of the test split (uint8 images of test_dataset, or
+    rows of the cached images/labels), decoded once into a pinned tensor and served by a TensorLoader to every evaluator
+    """
+    n = len(images) if images is not None else len(test_dataset)
+    if args.num_eval >= n:
+        idx = torch.arange(n)
+    else:
+        idx = torch.randperm(n, generator=torch.Generator().manual_seed(args.seed))[:args.num_eval].sort()[0]
+    # a distributed run evaluates one shard per process, the evaluators sum over the processes
+    # (--aa-shards deals out its own shards of the whole set)
+    if not args.aa_shards:
+        idx = idx[args.rank::args.world_size]
+    if images is not None:
+        X, y = torch.from_numpy(images[idx.numpy()]), torch.from_numpy(labels[idx.numpy()])
+    else:
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(test_dataset, idx.tolist()),
+                                             batch_size=256, num_workers=16)
+        X, y = [torch.cat(t) for t in zip(*loader)]
+    if args.device.type == 'cuda':
+        X = X.pin_memory()
+    mean, std, _ = DATASET_STATS[args.dataset]
+    normalize = not args.eval_bb and not args.fold_norm
+    return TensorLoader(X, y, 2 * args.batch_size // args.world_size, args.device,
+                        mean=mean if normalize else None, std=std if normalize else None, index=idx)
+
 
 def get_loaders(args):
-    if args.dataset=="cifar10":
-        mean =cifar10_mean
-        std = cifar10_std
-    elif args.dataset=='cifar100':
-        mean = cifar100_mean
-        std = cifar100_std
-    elif args.dataset=="imagenette" or args.dataset=="imagenet":
-        mean = imagenet_mean
-        std = imagenet_std
+    mean, std, _ = DATASET_STATS[args.dataset]
     train_list = [
         transforms.Resize([args.resize,args.resize]),
         transforms.RandomCrop(args.crop, padding=4),
         transforms.RandomHorizontalFlip(),
     ]
     train_list.append(transforms.ToTensor())
-    train_list.append(transforms.Normalize(mean, std))
+    if not args.fold_norm:
+        train_list.append(transforms.Normalize(mean, std))
     train_transform = transforms.Compose(train_list)
-    tlist = [
+    # uint8 for get_eval_set, which normalizes on the device
+    test_transform = transforms.Compose([
         transforms.Resize([args.resize,args.resize]),
-        transforms.ToTensor()
-    ]
-    if not args.eval_bb:
-        tlist.append(transforms.Normalize(mean, std))
-    test_transform = transforms.Compose(tlist)
+        transforms.PILToTensor()
+    ])
     num_workers = 16
     if args.dataset=="cifar10":
         train_dataset = datasets.CIFAR10(
@@ -88,20 +408,24 @@ def get_loaders(args):
     if args.dataset == "imagenet":
         train_dataset = datasets.ImageFolder(args.data_dir+"imagenet/train/",train_transform)
         test_dataset = datasets.ImageFolder(args.data_dir+"imagenet/val/",test_transform)
+    if args.data_cache:
+        return get_cached_loaders(args, train_dataset, test_dataset)
+    if args.delta_init == 'previous':
+        train_dataset = IndexedDataset(train_dataset)
+    # --batch-size is the global batch, split over the processes of a distributed run
+    sampler = None
+    if args.world_size > 1:
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            train_dataset, num_replicas=args.world_size, rank=args.rank, shuffle=True, seed=args.seed)
     train_loader = torch.utils.data.DataLoader(
         dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-        num_workers=num_workers,
-    )
-    test_loader = torch.utils.data.DataLoader(
-        dataset=test_dataset,
-        batch_size=2*args.batch_size,
-        shuffle=True if args.num_eval < len(test_dataset) else False ,
-        pin_memory=True,
+        batch_size=args.batch_size // args.world_size,
+        shuffle=sampler is None,
+        sampler=sampler,
+        pin_memory=args.device.type == 'cuda',
         num_workers=num_workers,
     )
+    test_loader = get_eval_set(args, test_dataset)
     return train_loader, test_loader
 
 _logger = logging.getLogger(__name__)
\ No newline at end of file
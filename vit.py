@@ -20,6 +20,7 @@ paper `DeiT: Data-efficient Image Transformers` - https://arxiv.org/abs/2012.128
 Hacked together by / Copyright 2020 Ross Wightman
 """
 import math
+import os
 import logging
 from functools import partial
 from collections import OrderedDict
@@ -30,9 +31,12 @@ import torch.nn.functional as F
 import timm
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+from timm.models import get_pretrained_cfg
 from timm.models.helpers import load_pretrained
 from timm.models.layers import StdConv2dSame, DropPath, to_2tuple, trunc_normal_
 
+from utils import build_once, save_atomic
+
 _logger = logging.getLogger(__name__)
 
 
@@ -153,8 +157,10 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., attn_impl='math'):
         super().__init__()
+        assert attn_impl in ('math', 'sdpa')
+        self.attn_impl = attn_impl
         self.num_heads = num_heads
         head_dim = dim // num_heads
         # NOTE scale factor was wrong in my original version, can set manually to be compat with prev weights
@@ -166,16 +172,44 @@ class Attention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.v_mask = nn.Identity()
 
+    def attend(self, q, k, v):
+        if self.attn_impl == 'sdpa':
+            # fused kernel, never materializes the (B, heads, N, N) attention matrix
+            return F.scaled_dot_product_attention(
+                q, k, v, dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+        return attn @ v
+
     def forward(self, x):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
         v = self.v_mask(v)
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = self.attend(q, k, v).transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def forward_prefix(self, x, prefix, index=None):
+        """ Attention for the rows of x only, with prefix tokens contributing keys/values.
+        prefix is input independent (batch 1), so its K/V are computed once and expanded.
+        With index, prefix is a bank (batch T) and sample b attends to the K/V of prefix[index[b]].
+        """
+        B, N, C = x.shape
+        L = prefix.size(1)
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        pkv = self.qkv(prefix)[:, :, C:].reshape(prefix.size(0), L, 2, self.num_heads, C // self.num_heads)
+        pkv = pkv.permute(2, 0, 3, 1, 4)
+        pkv = pkv.expand(-1, B, -1, -1, -1) if index is None else pkv[:, index]
+        q = qkv[0]
+        k = torch.cat((pkv[0], qkv[1]), dim=2)
+        v = torch.cat((pkv[1], qkv[2]), dim=2)
+
+        v = self.v_mask(v)
+        x = self.attend(q, k, v).transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -184,11 +218,12 @@ class Attention(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_impl='math'):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            attn_impl=attn_impl)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -200,6 +235,12 @@ class Block(nn.Module):
         x = x + self.mlp(self.norm2(x))
         return x
 
+    def forward_prefix(self, x, prefix, index=None):
+        # prefix rows only serve as keys/values, their outputs are never computed
+        x = x + self.drop_path(self.attn.forward_prefix(self.norm1(x), self.norm1(prefix), index=index))
+        x = x + self.mlp(self.norm2(x))
+        return x
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
@@ -273,7 +314,8 @@ class VisionTransformer(nn.Module):
     """
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, representation_size=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None,**kwargs):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None,
+                 prefix_kv=False, attn_impl='math', **kwargs):
         """
         Args:
             img_size (int, tuple): input image size
@@ -292,12 +334,15 @@ class VisionTransformer(nn.Module):
             drop_path_rate (float): stochastic depth rate
             hybrid_backbone (nn.Module): CNN backbone to use in-place of PatchEmbed module
             norm_layer: (nn.Module): normalization layer
+            prefix_kv (bool): run P2T prompts as batch-1 prefix keys/values instead of full token rows
+            attn_impl (str): 'math' for explicit softmax attention, 'sdpa' for F.scaled_dot_product_attention
         """
         super().__init__()
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
         norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
         self.depth = depth
+        self.prefix_kv = prefix_kv
         if hybrid_backbone is not None:
             self.patch_embed = HybridEmbed(
                 hybrid_backbone, img_size=img_size, in_chans=in_chans, embed_dim=embed_dim)
@@ -314,7 +359,7 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, attn_impl=attn_impl)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -358,7 +403,7 @@ class VisionTransformer(nn.Module):
     def get_embedding(self, x):
         return self.patch_embed(x)
         
-    def forward_features(self, x, prompt=None, deep=False):
+    def embed(self, x):
         B = x.shape[0]
         if x.shape[-1] != self.embed_dim:
             x = self.patch_embed(x)
@@ -366,22 +411,51 @@ class VisionTransformer(nn.Module):
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
         x = x + self.pos_embed
+        return x
+
+    def embed_perturbation(self, delta, clean):
+        """ Tokens of (X + delta) from the precomputed clean tokens of X, i.e. embed(X).
+        The patch conv is linear, so only the bias-free conv of delta is left to compute.
+        """
+        if delta is None:
+            return clean
+        proj = self.patch_embed.proj
+        d = F.conv2d(delta, proj.weight, stride=proj.stride).flatten(2).transpose(1, 2)
+        return torch.cat((clean[:, :1], clean[:, 1:] + d), dim=1)
+
+    def forward_features(self, x, prompt=None, deep=False, clean=None, prompt_index=None):
+        """ Returns the pre-logits cls feature and the normed tokens, the prompt rows first. The --prefix-kv path
+        never computes the prompt rows (their K/V are fixed), so its tokens are only the cls/patch rows, cls at 0.
+        """
+        if clean is not None:
+            x = self.embed_perturbation(x, clean)
+        else:
+            x = self.embed(x)
         x = self.pos_drop(x)
         shift = 0 if prompt is None else prompt.size(1)
+        prefix = not deep and self.prefix_kv and prompt is not None and prompt.size(-1) >= self.depth
+        # per-sample prompts from a bank, gathered one block at a time (the prefix path indexes the bank K/V instead)
+        take = (lambda p: p) if prompt_index is None else (lambda p: p[prompt_index])
         if deep:
             assert prompt.size(-1) == 1
             l = prompt.size(1)//self.depth
             for i, blk in enumerate(self.blocks):
                 s = i*l
                 e = (i + 1)*l if i + 1 < len(self.blocks) else prompt.size(1)
-                bprompt = prompt[:, s:e, :, :].view(1, e-s, prompt.size(2)).expand(x.size(0), e-s ,prompt.size(2))
+                bprompt = take(prompt[:, s:e, :, 0]).expand(x.size(0), -1, -1)
                 x = torch.cat((bprompt, x), dim=1)
                 x = blk(x)
+        elif prefix:
+            # every block overwrites the prompt rows, so their K/V never depend on the input
+            # and their outputs are discarded: only cls/patch rows are computed
+            shift = 0
+            for i, blk in enumerate(self.blocks):
+                x = blk.forward_prefix(x, prompt[:, :, :, i], index=prompt_index)
         else: 
             for i, blk in enumerate(self.blocks):
                 ind = i
                 if (prompt is not None) and (0 <= ind < prompt.size(-1)):
-                    bprompt = prompt[:, :, :, ind].view(1, prompt.size(1), prompt.size(2)).expand(x.size(0), prompt.size(1), prompt.size(2)) 
+                    bprompt = take(prompt[:, :, :, ind]).expand(x.size(0), -1, -1)
                     if ind == 0:
                         x = torch.cat((bprompt, x), dim=1)
                     else:
@@ -392,21 +466,36 @@ class VisionTransformer(nn.Module):
                     #     x[:, :prompt.size(1)] += bprompt
                 x = blk(x)
         x = self.norm(x)
+        assert x.size(1) == shift + self.pos_embed.size(1), 'tokens are the {} prompt rows and the cls/patch rows'.format(shift)
         x_cls = x[:, shift]
         x_cls = self.pre_logits(x_cls)
         return x_cls, x
 
-    def forward(self, x, prompt=None, get_fs=False, deep=False):
+    def forward(self, x, prompt=None, get_fs=False, deep=False, clean=None):
         if prompt is not None:
-            x, f = self.forward_features(x, prompt, deep)
+            x, f = self.forward_features(x, prompt, deep, clean=clean)
         else:
-            x, f = self.forward_features(x)
+            x, f = self.forward_features(x, clean=clean)
         out = self.head(x)
         if get_fs:
+            # the cls feature, the same with or without --prefix-kv (unlike the token layout of forward_features)
             return out, x
         else:
             return out
 
+    def forward_multi(self, x, prompts, index, heads, deep=False, clean=None):
+        """ Several prompt-tuned tasks in one backbone pass. prompts is a (T, L, D, depth) bank of same-shaped
+        prompts, index the task of every sample and heads the T task heads.
+        Returns (B, most classes) logits, -inf past the classes of a sample's task.
+        """
+        feats, _ = self.forward_features(x, prompts, deep, clean=clean, prompt_index=index)
+        out = feats.new_full((feats.size(0), max(h.out_features for h in heads)), -float('inf'))
+        for t, head in enumerate(heads):
+            rows = (index == t).nonzero()[:, 0]
+            if rows.numel():
+                out[rows, :head.out_features] = head(feats[rows])
+        return out
+
 
 class DistilledVisionTransformer(VisionTransformer):
     """ Vision Transformer with distillation token.
@@ -501,6 +590,30 @@ def checkpoint_filter_fn(state_dict, model,args):
     return out_dict
 
 
+def load_base_weights(variant, model, img_size, num_classes, default_num_classes, in_chans, args):
+    """ --weight-store: the pretrained state dict for model, filtered by checkpoint_filter_fn, computed once per
+    (variant, timm weight tag and version, img_size, patch, num_classes, in_chans) and memory-mapped afterwards,
+    without building the timm model. The head is left out when num_classes differs from the pretrained one (timm
+    only initializes it, the model keeps its own init) and timm runs under a forked RNG, so a cold and a warm store
+    give the same run; both differ from a run without the store in the head init and the RNG stream.
+    """
+    store = args.weight_store
+    cfg = get_pretrained_cfg(variant)
+    path = os.path.join(store, '{}.{}_timm{}_{}_p{}_c{}_in{}.pt'.format(
+        variant, getattr(cfg, 'tag', None) or 'default', timm.__version__, img_size, args.patch, num_classes, in_chans))
+    def build():
+        with torch.random.fork_rng(devices=[]):
+            model_timm = timm.create_model(variant, pretrained=True, num_classes=num_classes, in_chans=in_chans)
+        state_dict = checkpoint_filter_fn(model_timm.state_dict(), model, args)
+        if num_classes != default_num_classes:
+            state_dict = {k: v for k, v in state_dict.items() if not k.startswith('head.')}
+        return state_dict
+    os.makedirs(store, exist_ok=True)
+    # under torchrun rank 0 downloads and writes the store, the other processes memory-map the finished file
+    build_once(path, lambda: save_atomic(lambda tmp: torch.save(build(), tmp), path))
+    return torch.load(path, mmap=True, weights_only=True)
+
+
 def _create_vision_transformer(variant, pretrained=False, distilled=False, **kwargs):
     default_cfg = default_cfgs[variant]
     default_num_classes = default_cfg['num_classes']
@@ -523,8 +636,13 @@ def _create_vision_transformer(variant, pretrained=False, distilled=False, **kwa
     if pretrained:
         # print(model.default_cfg)
         _logger.warning(variant)
-        model_timm = timm.create_model(variant, pretrained=True, num_classes=num_classes, in_chans=kwargs.get('in_chans', 3))
-        model.load_state_dict(checkpoint_filter_fn(model_timm.state_dict(), model, kwargs.pop('args')))
+        if getattr(args, 'weight_store', ''):
+            state_dict = load_base_weights(variant, model, img_size, num_classes, default_num_classes, kwargs.get('in_chans', 3), args)
+            missing = model.load_state_dict(state_dict, strict=False, assign=True).missing_keys
+            assert all(k.startswith('head.') for k in missing), missing
+        else:
+            model_timm = timm.create_model(variant, pretrained=True, num_classes=num_classes, in_chans=kwargs.get('in_chans', 3))
+            model.load_state_dict(checkpoint_filter_fn(model_timm.state_dict(), model, args))
         # load_pretrained(
         #     model, num_classes=num_classes, in_chans=kwargs.get('in_chans', 3),
         #     filter_fn=partial(checkpoint_filter_fn, args=kwargs.pop('args') , model=model))